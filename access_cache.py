@@ -0,0 +1,214 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from gcp_clients import get_service
+from rate_limit import error_status, get_governor, is_quota_error
+from sweep_executor import default_max_workers, run_sweep
+
+# Where the (project, API) pairs that cannot be counted are remembered between runs
+access_cache_path = os.environ.get(
+    'ACCESS_CACHE_DB',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'access_cache.sqlite')
+)
+
+# How long each kind of denial is trusted before the call is tried again
+denial_ttls = {
+    'api_disabled': 24 * 60 * 60,
+    'permission_denied': 6 * 60 * 60,
+    'project_deleted': 7 * 24 * 60 * 60,
+}
+
+# Error reasons of a disabled API (googleapis error body and google.rpc.ErrorInfo)
+api_disabled_reasons = ('accessNotConfigured', 'SERVICE_DISABLED')
+
+# Messages of calls made in a project that is gone or on its way out
+project_deleted_phrases = ('projectNotFound', 'scheduled for deletion', 'has been deleted', 'CONSUMER_INVALID')
+
+_schema = """CREATE TABLE IF NOT EXISTS denials (
+                 project_id TEXT, api TEXT, reason TEXT, message TEXT, until REAL,
+                 PRIMARY KEY (project_id, api))"""
+
+def _error_text(error):
+    """Returns the error body and message of an API error, where its reasons are spelled out."""
+    content = getattr(error, 'content', b'') or b''
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    return f"{content} {error}"
+
+def classify_error(error):
+    """Returns 'api_disabled', 'permission_denied' or 'project_deleted' for errors that will not go away
+    by retrying, or None for everything else (quota, outages, bugs)."""
+    status = error_status(error)
+    if status not in (400, 403, 404) or is_quota_error(error):
+        return None
+    text = _error_text(error)
+    if any(reason in text for reason in api_disabled_reasons):
+        return 'api_disabled'
+    # Listings are project-wide, so they only get a 404 when the project itself cannot be found
+    if status == 404 or any(phrase in text for phrase in project_deleted_phrases):
+        return 'project_deleted'
+    if status == 403:
+        return 'permission_denied'
+    return None
+
+def _denied_api(api, reason, collection=None):
+    """Returns what a denial is kept under: '*' for a deleted project, '<api>.<collection>' for a
+    permission denied on one collection's list method, and the API itself for a disabled API."""
+    if reason == 'project_deleted':
+        return '*'
+    if reason == 'permission_denied' and collection:
+        return f"{api}.{collection}"
+    return api
+
+class AccessCache:
+    """Remembers (project, API) pairs whose calls fail for good, so sweeps skip them until the denial expires.
+
+    Denials live in SQLite, so every thread and worker process of a sweep shares them; a deleted
+    project is denied for every API at once, and a denied permission only covers the collection whose
+    list call failed. With `recheck`, known denials are ignored (but still refreshed or cleared by the
+    calls that are made).
+    """
+
+    def __init__(self, path=access_cache_path, ttls=None):
+        self.path = path
+        self.ttls = dict(denial_ttls, **(ttls or {}))
+        self.recheck = False
+        self._db = None
+        self._denials = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        """Opens the database and loads the denials that have not expired; call with the lock held."""
+        if self._db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            with self._db:
+                self._db.execute(_schema)
+                self._db.execute("DELETE FROM denials WHERE until < ?", (time.time(),))
+                # Permission denials used to cover the whole API; they now belong to one collection
+                self._db.execute("DELETE FROM denials WHERE reason = 'permission_denied' AND api NOT LIKE '%.%'")
+            self._denials = {(project_id, api): (reason, message, until) for project_id, api, reason, message, until
+                             in self._db.execute("SELECT project_id, api, reason, message, until FROM denials")}
+        return self._db
+
+    def _keys(self, project_id, api, collection=None):
+        """Returns the denial keys that apply to a call of `api` (on `collection`) in the project."""
+        keys = [(project_id, api), (project_id, '*')]
+        if collection:
+            keys.insert(0, (project_id, f"{api}.{collection}"))
+        return keys
+
+    def denial(self, project_id, api, collection=None):
+        """Returns the (reason, message) of a denial that still holds for `api` (or its `collection`) in
+        the project, or None."""
+        if self.recheck:
+            return None
+        now = time.time()
+        with self._lock:
+            self._open()
+            for key in self._keys(project_id, api, collection):
+                entry = self._denials.get(key)
+                if entry is not None and entry[2] > now:
+                    return entry[0], entry[1]
+        return None
+
+    def deny(self, project_id, api, reason, message='', collection=None):
+        """Remembers that `api` calls in the project fail for `reason` ('*' and project_deleted cover every
+        API; permission_denied with a `collection` only covers that collection)."""
+        api = _denied_api(api, reason, collection)
+        until = time.time() + self.ttls[reason]
+        with self._lock:
+            db = self._open()
+            with db:
+                db.execute("INSERT OR REPLACE INTO denials VALUES (?, ?, ?, ?, ?)",
+                           (project_id, api, reason, message[:500], until))
+            self._denials[(project_id, api)] = (reason, message, until)
+        logging.info(f"Skipping {api} calls in {project_id} for the next {self.ttls[reason] // 3600}h: {reason}")
+
+    def allow(self, project_id, api, collection=None):
+        """Forgets the denials of `api` (and its `collection`) in the project, e.g. after a call succeeded or
+        the API was found enabled."""
+        with self._lock:
+            db = self._open()
+            keys = [key for key in self._keys(project_id, api, collection) if key in self._denials]
+            if not keys:
+                return
+            with db:
+                db.executemany("DELETE FROM denials WHERE project_id = ? AND api = ?", keys)
+            for key in keys:
+                del self._denials[key]
+
+    def observe(self, project_id, api, error, collection=None):
+        """Remembers a failed call (on `collection`) if it will keep failing; returns the reason, or None if
+        it may succeed later."""
+        reason = classify_error(error)
+        if reason is not None:
+            self.deny(project_id, api, reason, str(error), collection=collection)
+        return reason
+
+    def stats(self):
+        """Returns the number of denials in force per reason."""
+        now = time.time()
+        with self._lock:
+            self._open()
+            reasons = [reason for reason, _, until in self._denials.values() if until > now]
+        return {reason: reasons.count(reason) for reason in sorted(set(reasons))}
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+_default_access_cache = AccessCache()
+
+def get_access_cache():
+    """Returns the process-wide access cache."""
+    return _default_access_cache
+
+def precheck_services(projects, apis, cache=None, max_workers=default_max_workers):
+    """Looks up which of `apis` are enabled in each project, with one Service Usage batchGet call per project.
+
+    Disabled APIs are denied in the cache and enabled ones cleared, so the sweep leaves out the calls
+    that are bound to fail and retries APIs as soon as they are enabled. Returns {project: disabled APIs}.
+    """
+    cache = cache or get_access_cache()
+    apis = sorted(set(apis))
+    disabled = {}
+
+    def check_enabled_services(target_project_id):
+        # A project known to be gone has nothing to check
+        denial = cache.denial(target_project_id, '*')
+        if denial is not None and denial[0] == 'project_deleted':
+            return None
+        parent = f"projects/{target_project_id}"
+        request = get_service('serviceusage', 'v1').services().batchGet(
+            parent=parent, names=[f"{parent}/services/{api}.googleapis.com" for api in apis])
+        try:
+            response = get_governor().execute('serviceusage', request.execute)
+        except Exception as e:
+            # Not being allowed to read the services says nothing about the APIs themselves
+            if classify_error(e) == 'project_deleted':
+                cache.deny(target_project_id, '*', 'project_deleted', str(e))
+            else:
+                logging.warning(f"Could not check the enabled services of {target_project_id}: {e}")
+            return None
+
+        states = {service['name'].rsplit('/', 1)[-1].split('.', 1)[0]: service.get('state')
+                  for service in response.get('services', [])}
+        for api in apis:
+            if states.get(api) == 'ENABLED':
+                cache.allow(target_project_id, api)
+            else:
+                cache.deny(target_project_id, api, 'api_disabled', f"{api}.googleapis.com is not enabled")
+                disabled.setdefault(target_project_id, []).append(api)
+        return len(disabled.get(target_project_id, []))
+
+    run_sweep(projects, [check_enabled_services], max_workers=max_workers)
+    logging.info(f"Service check: {sum(len(found) for found in disabled.values())} disabled APIs "
+                 f"in {len(disabled)} of {len(projects)} projects")
+    return disabled
@@ -1,8 +1,14 @@
+import argparse
+import functools
 import logging
-from googleapiclient.discovery import build
-from google.auth import default
-from google.cloud import storage
-from google.cloud import resourcemanager_v3
+from count_history import CountHistory, count_history_path
+from gcp_clients import get_storage_client
+from project_inventory import build_project_query, discover_projects
+from resource_registry import count_resource
+from run_report import RunReport
+from sharding import WorkQueue, default_lease_seconds, run_in_processes, work_in_processes
+from sweep_executor import default_max_workers, run_sweep
+from sweep_journal import SweepJournal, completed_jobs, journal_path
 
 # Configure logging to send logs to the console and a log sink
 logging.basicConfig(
@@ -13,48 +19,142 @@ logging.basicConfig(
     ]
 )
 
-# Configure Cloud Storage
-storage_client = storage.Client()
+# Configure Cloud Storage (the client is created on the first upload)
 bucket_name = 'metric-count'  # Replace with your Cloud Storage bucket name
 blob_name = 'vpn_tunnel_counts.txt'  # Replace with your desired blob name
 
+# Counts made by this process; sharded runs merge every process's counts into the parent's report
+run_report = RunReport()
+
 def count_vpn_tunnels(target_project_id):
-    """Counts VPN Tunnels in the target project and writes the count to the log."""
+    """Counts VPN Tunnels in the target project, writes the count to the log and adds it to the run report."""
     try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # Specify the region for VPN Tunnels
-        region = 'us-central1'  # Replace with your actual region
-
-        # List VPN Tunnels in the target project and region
-        response = service.vpnTunnels().list(project=target_project_id, region=region).execute()
-        vpn_tunnel_count = len(response.get('items', []))
+        # Count VPN Tunnels in every region with the registry's aggregatedList listing
+        region_counts = count_resource('vpn_tunnel', target_project_id)['regions']
+        vpn_tunnel_count = sum(region_counts.values())
 
-        # Log the VPN Tunnel count to the console
+        # Label each count with its region, followed by the project total
+        for region, count in sorted(region_counts.items()):
+            logging.info(f"VPN Tunnel Count in {target_project_id} (region={region}): {count}")
+            run_report.record(target_project_id, 'vpn_tunnel', count, region=region)
         logging.info(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}")
-
-        # Write the VPN Tunnel count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}\n",
-                                 content_type='text/plain')
+        run_report.record(target_project_id, 'vpn_tunnel', vpn_tunnel_count)
+        return vpn_tunnel_count
 
     except Exception as e:
         # Log the error to the console
         logging.error(f"Error counting VPN Tunnels in {target_project_id}: {e}")
+        run_report.record(target_project_id, 'vpn_tunnel', error=str(e))
+
+def count_projects(projects, workers=default_max_workers, journal_file=None, done=None):
+    """Counts VPN Tunnels in a list of projects on a thread pool and returns their run report records.
+
+    Records are also appended to `journal_file` as they are made; projects in `done` are skipped.
+    """
+    global run_report
+    run_report = RunReport()
+    if journal_file:
+        run_report.journal = SweepJournal(journal_file).open()
+    try:
+        run_sweep([project for project in projects if (project, 'vpn_tunnel') not in (done or ())],
+                  [count_vpn_tunnels], max_workers=workers)
+    finally:
+        if run_report.journal is not None:
+            run_report.journal.close()
+    return run_report.records()
+
+def write_counts(report):
+    """Writes every project's VPN Tunnel counts to Cloud Storage as one text object."""
+    count_lines = []
+    for record in report.records():
+        if record['error'] is not None:
+            continue
+        region = f" (region={record['region']})" if record['region'] else ''
+        count_lines.append(f"VPN Tunnel Count in {record['project_id']}{region}: {record['count']}")
+
+    blob = get_storage_client().bucket(bucket_name).blob(blob_name)
+    blob.upload_from_string("".join(f"{line}\n" for line in count_lines), content_type='text/plain')
+    logging.info(f"Wrote {len(count_lines)} VPN Tunnel counts to gs://{bucket_name}/{blob_name}")
+
+def find_projects():
+    """Finds the ACTIVE "hst-tst" projects, letting Resource Manager filter by state and
+    reusing the local project inventory while it is fresh."""
+    return discover_projects(query=build_project_query(), contains="hst-tst")
 
 if __name__ == "__main__":
-    # Get all projects from the GCP
-    client = resourcemanager_v3.ProjectsClient()
+    parser = argparse.ArgumentParser(description="Counts VPN Tunnels in every matching project.")
+    parser.add_argument('--workers', type=int, default=default_max_workers,
+                        help="Projects counted at the same time by each process")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Split the projects by stable hash across this many worker processes")
+    parser.add_argument('--queue', metavar='PATH',
+                        help="SQLite work queue shared by every machine taking part in the sweep")
+    parser.add_argument('--enqueue', action='store_true', help="With --queue, queue the projects for a new run")
+    parser.add_argument('--work', action='store_true', help="With --queue, count queued projects until none are left")
+    parser.add_argument('--collect', action='store_true',
+                        help="With --queue, wait for the run to finish, then write the merged counts")
+    parser.add_argument('--run-id', help="With --queue, the run to work on (defaults to the latest queued run)")
+    parser.add_argument('--lease-seconds', type=int, default=default_lease_seconds,
+                        help="With --queue, how long claimed projects stay with a worker before others may take them")
+    parser.add_argument('--history', nargs='?', const=count_history_path, metavar='PATH',
+                        help="Also add the counts to the local history database used by count_history.py")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the last interrupted run from its journal, counting only the projects it had not finished")
+    parser.add_argument('--journal', default=journal_path('allprojectsvpntunnel_count'),
+                        help="Where each count is journaled as it is made, for --resume")
+    args = parser.parse_args()
+
+    def write_report(report):
+        """Writes the merged counts to Cloud Storage and, if asked, to the local history."""
+        write_counts(report)
+        if args.history:
+            history = CountHistory(args.history)
+            history.append(report)
+            history.compact()
+            history.close()
+
+    if not args.queue:
+        # Journal every count as it is made; when resuming, keep the finished counts and the run ID
+        journal = SweepJournal(args.journal)
+        run_id, journaled = journal.start(run_report.run_id, resume=args.resume)
+        journal.close()
+        done = completed_jobs(journaled)
+
+        # One machine: split the projects across processes and merge their counts into one report
+        projects = find_projects()
+        shard_counter = functools.partial(count_projects, workers=args.workers, journal_file=args.journal, done=done)
+        if args.processes > 1:
+            records = run_in_processes(projects, shard_counter, args.processes)
+        else:
+            records = shard_counter(projects)
+
+        merged = RunReport()
+        merged.run_id = run_id
+        merged.extend([record for record in journaled if (record['project_id'], record['resource']) in done])
+        merged.extend(records)
+        write_report(merged)
 
-    # Listing all projects (without parent)
-    projects = [project.project_id for project in client.list_projects()]
+        # Everything is written out, so the next run starts from scratch
+        journal.finish()
+    else:
+        queue = WorkQueue(args.queue, lease_seconds=args.lease_seconds)
+        if args.enqueue:
+            queue.enqueue(args.run_id or run_report.run_id, find_projects())
+        run_id = args.run_id or queue.latest_run()
+        if run_id is None:
+            parser.error(f"No run queued in {args.queue}; run with --enqueue first")
 
-    # Filter projects based on "hst-tst" prefix
-    filtered_projects = [project for project in projects if "hst-tst" in project]
+        if args.work:
+            # Any number of machines can run this step against the same queue at the same time
+            shard_counter = functools.partial(count_projects, workers=args.workers)
+            counted = work_in_processes(queue, run_id, shard_counter, args.processes)
+            logging.info(f"This machine counted {counted} projects of run {run_id}")
 
-    for project in filtered_projects:
-        count_vpn_tunnels(project)  # Count VPN Tunnels in each project
+        if args.collect:
+            # Merge every worker's counts into one report and write it once
+            progress = queue.wait(run_id)
+            if progress['failed']:
+                logging.warning(f"{progress['failed']} projects of run {run_id} failed on every attempt")
+            merged = RunReport()
+            merged.extend(queue.records(run_id))
+            write_report(merged)
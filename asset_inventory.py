@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import re
+
+from gcp_clients import get_service
+from list_paging import IdSetFingerprint, iter_pages
+from resource_registry import get_definition, log_count_lines, record_error, record_results, resource_names
+from sweep_executor import default_max_workers, run_sweep
+
+# Fields of each search result the counts need; the resource body is only read when a match needs it
+asset_read_mask = 'name,assetType,location'
+
+# Full resource names look like //compute.googleapis.com/projects/<project>/regions/<region>/vpnTunnels/<name>
+_project_pattern = re.compile(r'^//[^/]+/projects/([^/]+)/')
+
+def asset_project(name):
+    """Returns the project ID in a full resource name, or None."""
+    match = _project_pattern.match(name or '')
+    return match.group(1) if match else None
+
+def search_params(scope, resources):
+    """Returns the searchAllResources parameters that find every asset of `resources` under `scope`."""
+    definitions = [get_definition(resource) for resource in resources]
+    read_mask = asset_read_mask
+    if any(definition.get('match') or definition.get('items_field') for definition in definitions):
+        # The resource body is needed to tell e.g. Private Service Access ranges apart from other addresses,
+        # or to count the peerings of each network
+        read_mask += ',versionedResources'
+    return {
+        'scope': scope,
+        'assetTypes': sorted({definition['asset_type'] for definition in definitions}),
+        'readMask': read_mask,
+    }
+
+def iter_assets(scope, resources):
+    """Yields the search results for `resources` under `scope` (an organization, folder or project), page by page."""
+    params = search_params(scope, resources)
+    for page in iter_pages(get_service('cloudasset', 'v1').v1(), api='cloudasset', method='searchAllResources',
+                           **params):
+        yield from page.get('results', [])
+
+class AssetCount:
+    """Counts asset search results per project and resource, with the same regions and fingerprints as a listing."""
+
+    def __init__(self, resources, projects=None):
+        self.resources = list(resources)
+        self.projects = set(projects) if projects is not None else None
+        self._by_asset_type = {}
+        for resource in self.resources:
+            definition = get_definition(resource)
+            self._by_asset_type.setdefault(definition['asset_type'], []).append(definition)
+        self.counts = {}
+        self.regions = {}
+        self.fingerprints = {}
+
+    def _tally(self, project_id, resource):
+        key = (project_id, resource)
+        if key not in self.counts:
+            self.counts[key] = 0
+            self.regions[key] = {}
+            self.fingerprints[key] = IdSetFingerprint()
+        return key
+
+    def add(self, result):
+        """Adds one search result."""
+        project_id = asset_project(result.get('name'))
+        if project_id is None or (self.projects is not None and project_id not in self.projects):
+            return
+        data = next((version.get('resource', {}) for version in result.get('versionedResources', [])), {})
+        item_name = result['name'].rsplit('/', 1)[-1]
+
+        region = result.get('location')
+        # Same IDs as the listings ("regions/<region>/<name>" for aggregatedList), so fingerprints agree
+        item_id = f"regions/{region}/{item_name}" if region and region != 'global' else item_name
+
+        for definition in self._by_asset_type.get(result.get('assetType'), []):
+            # The asset itself, or the entries of one of its list fields (e.g. a network's peerings)
+            items_field = definition.get('items_field')
+            if items_field:
+                counted = [(entry, f"{item_id}/{entry.get('name')}") for entry in data.get(items_field) or []]
+            else:
+                counted = [(data, item_id)]
+            for entry, entry_id in counted:
+                if not all(entry.get(field) == value for field, value in (definition.get('match') or {}).items()):
+                    continue
+                key = self._tally(project_id, definition['resource'])
+                self.counts[key] += 1
+                if definition['scope'] == 'regional':
+                    self.regions[key][region] = self.regions[key].get(region, 0) + 1
+                self.fingerprints[key].add(entry_id)
+
+    def results(self, project_id):
+        """Returns {resource: {'count', 'regions', 'fingerprint', 'breakdowns'}} for one project, like
+        count_listing does; breakdowns are None, as search results leave out the fields they group by."""
+        results = {}
+        for resource in self.resources:
+            key = self._tally(project_id, resource)
+            results[resource] = {
+                'count': self.counts[key],
+                'regions': self.regions[key] if get_definition(resource)['scope'] == 'regional' else None,
+                'fingerprint': self.fingerprints[key].hexdigest(),
+                'breakdowns': None,
+            }
+        return results
+
+def count_assets(scope, resources=None, projects=None):
+    """Counts `resources` in every project under `scope` with one search; returns the AssetCount."""
+    tally = AssetCount(resources or resource_names, projects)
+    for result in iter_assets(scope, tally.resources):
+        tally.add(result)
+    return tally
+
+def count_with_assets(projects, record, log=log_count_lines, resources=None, scope=None,
+                      max_workers=default_max_workers, done=None):
+    """Counts `resources` in `projects` with Cloud Asset Inventory and records them like the listing counters do.
+
+    With a scope (e.g. 'organizations/123') the whole fleet is counted in one paged search; without one,
+    each project is searched on its own, which still takes one search per project instead of one per type.
+    The (project, resource) pairs in `done` are neither searched for nor recorded.
+    """
+    resources = list(resources or resource_names)
+    done = done or set()
+    remaining = {project_id: [resource for resource in resources if (project_id, resource) not in done]
+                 for project_id in projects}
+    projects = [project_id for project_id in projects if remaining[project_id]]
+    if not projects:
+        return {}
+    if scope:
+        searched = [resource for resource in resources if any(resource in remaining[p] for p in projects)]
+        try:
+            tally = count_assets(scope, searched, projects)
+        except Exception as e:
+            for project_id in projects:
+                record_error(record, log, project_id, remaining[project_id], e)
+            return {}
+        counts = {}
+        for project_id in projects:
+            # Projects without any of the assets still get their zero counts
+            results = {resource: result for resource, result in tally.results(project_id).items()
+                       if resource in remaining[project_id]}
+            record_results(record, log, project_id, results)
+            counts.update({(project_id, resource): result['count'] for resource, result in results.items()})
+        return counts
+
+    counts = {}
+
+    def count_project_assets(target_project_id):
+        try:
+            tally = count_assets(f"projects/{target_project_id}", remaining[target_project_id], [target_project_id])
+        except Exception as e:
+            record_error(record, log, target_project_id, remaining[target_project_id], e)
+            return None
+        results = tally.results(target_project_id)
+        record_results(record, log, target_project_id, results)
+        counts.update({(target_project_id, resource): result['count'] for resource, result in results.items()})
+        return sum(result['count'] for result in results.values())
+
+    run_sweep(projects, [count_project_assets], max_workers=max_workers)
+    return counts
+
+def compare_reports(expected, actual):
+    """Returns a line for every (project, resource, region) whose count or items differ between two run reports.
+
+    Resources that either report could not count (an error, or a skipped disabled API) are left out.
+    """
+    def counts(report):
+        return {(r['project_id'], r['resource'], r['region'] or ''): (r['count'], r['fingerprint'])
+                for r in report.records() if r['error'] is None}
+
+    def failed(report):
+        return {(r['project_id'], r['resource']) for r in report.records() if r['error'] is not None}
+
+    expected_counts, actual_counts = counts(expected), counts(actual)
+    uncounted = failed(expected) | failed(actual)
+    differences = []
+    for key in sorted(set(expected_counts) | set(actual_counts)):
+        if key[:2] in uncounted:
+            continue
+        expected_count, expected_fingerprint = expected_counts.get(key, (None, None))
+        actual_count, actual_fingerprint = actual_counts.get(key, (None, None))
+        project_id, resource, region = key
+        where = f" (region={region})" if region else ''
+        if expected_count != actual_count:
+            differences.append(f"{resource} in {project_id}{where}: {expected_count} listed, {actual_count} in assets")
+        elif expected_fingerprint != actual_fingerprint:
+            differences.append(f"{resource} in {project_id}{where}: same count, different items")
+    return differences
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Records Cloud Asset Inventory search results for the registered "
+                                                 "resources, e.g. to replay them with fake_gcp_server.py.")
+    parser.add_argument('scope', help="Scope to search, e.g. organizations/123, folders/456 or projects/my-project")
+    parser.add_argument('--resource', action='append', choices=resource_names,
+                        help="Resource type to search for (repeatable, defaults to every registered type)")
+    parser.add_argument('--output', default='asset_recording.jsonl', help="Where to write one result per line")
+    args = parser.parse_args()
+
+    # Stream the results straight to disk, so a large organization never sits in memory
+    written = 0
+    with open(args.output, 'w') as f:
+        for result in iter_assets(args.scope, args.resource or resource_names):
+            f.write(json.dumps(result) + '\n')
+            written += 1
+    logging.info(f"Wrote {written} search results under {args.scope} to {args.output}")
@@ -0,0 +1,114 @@
+import logging
+from list_paging import list_request
+from rate_limit import get_governor
+from run_metrics import get_metrics
+
+# Google APIs accept at most 1000 calls in one batch request
+max_batch_size = 1000
+
+def _page_fields(method, items_key):
+    """Returns the partial-response field mask for counting one page of a list or aggregatedList call."""
+    if method == 'aggregatedList':
+        return f"items/*/{items_key}(name),nextPageToken"
+    return f"{items_key}(name),nextPageToken"
+
+def _add_page(results, key, method, items_key, page, on_page=None):
+    """Adds one page's items to a job's result: a total for list calls, per-region counts for aggregatedList."""
+    if on_page is not None:
+        # The caller counts the page itself; only track that the job got this far
+        on_page(key, page)
+        results[key] = results.get(key, 0) + 1
+    elif method == 'aggregatedList':
+        region_counts = results.setdefault(key, {})
+        for scope, scoped_list in page.get('items', {}).items():
+            items = scoped_list.get(items_key, [])
+            if items:
+                region = scope.split('/')[-1]
+                region_counts[region] = region_counts.get(region, 0) + len(items)
+    else:
+        results[key] = results.get(key, 0) + len(page.get(items_key, []))
+
+def count_in_batches(service, jobs, api='compute', batch_size=max_batch_size, on_page=None, errors=None):
+    """Counts the items of many independent list calls on one API with batched HTTP requests.
+
+    Each job is (key, collection, method, items_key, params), e.g.
+    (('my-project', 'Firewall'), 'firewalls', 'list', 'items', {'project': 'my-project'}).
+    Returns {key: count} for list calls and {key: {region: count}} for aggregatedList calls;
+    jobs that keep failing after being retried one by one map to None, and with an `errors` dict their
+    keys map to the last exception there.
+
+    With on_page, every response page is handed to on_page(key, page) instead of being counted, a
+    'fields' entry in params replaces the default field mask, and keys map to their number of pages.
+    """
+    from googleapiclient.errors import HttpError
+
+    results = {}
+    failed = {}
+
+    # Every pending entry is (job, request); follow-up pages are queued for the next round
+    pending = []
+    for key, collection, method, items_key, params in jobs:
+        resource = getattr(service, collection)()
+        params = dict(params)
+        fields = params.pop('fields', None) or _page_fields(method, items_key)
+        request = list_request(resource, api=api, method=method, fields=fields, **params)
+        pending.append(((key, collection, resource, method, items_key), request))
+
+    round_number = 0
+    while pending:
+        round_number += 1
+        next_pending = []
+        retry = []
+
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+
+            def callback(request_id, response, exception, chunk=chunk):
+                job, request = chunk[int(request_id)]
+                if exception is not None:
+                    retry.append((job, request, exception))
+                    return
+                key, collection, resource, method, items_key = job
+                get_metrics().inc('list_pages', service=api)
+                _add_page(results, key, method, items_key, response, on_page)
+                next_request = getattr(resource, f"{method}_next")(previous_request=request, previous_response=response)
+                if next_request is not None:
+                    next_pending.append((job, next_request))
+
+            # One multipart HTTP request carries the whole chunk
+            batch = service.new_batch_http_request(callback=callback)
+            for index, (job, request) in enumerate(chunk):
+                batch.add(request, request_id=str(index))
+            get_governor().execute(api, batch.execute)
+
+        logging.info(f"Batch round {round_number}: {len(pending)} calls, {len(retry)} failed, "
+                     f"{len(next_pending)} follow-up pages")
+
+        # Failed sub-requests are retried one by one through the governor, which backs off on quota errors
+        for job, request, exception in retry:
+            key, collection, resource, method, items_key = job
+            logging.warning(f"Retrying {collection} for {key} after batch failure: {exception}")
+            try:
+                response = get_governor().execute(api, request.execute)
+            except HttpError as e:
+                logging.error(f"Error listing {collection} for {key}: {e}")
+                failed[key] = e
+                continue
+            get_metrics().inc('list_pages', service=api)
+            _add_page(results, key, method, items_key, response, on_page)
+            next_request = getattr(resource, f"{method}_next")(previous_request=request, previous_response=response)
+            if next_request is not None:
+                next_pending.append((job, next_request))
+
+        pending = next_pending
+
+    # Jobs with an empty first page still get a zero count; failed jobs get None
+    for key, collection, method, items_key, params in jobs:
+        if key in failed:
+            results[key] = None
+        elif key not in results:
+            results[key] = {} if method == 'aggregatedList' and on_page is None else 0
+
+    if errors is not None:
+        errors.update(failed)
+    return results
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Entry points whose import and --help times are guarded
+entry_points = [
+    'withoutprojectfilters_networksummary',
+    'countwithoutprojectfilters',
+    'collector_daemon',
+]
+
+# SDK modules that must only be imported once a code path needs them
+heavy_modules = [
+    'google.cloud.storage',
+    'google.cloud.logging',
+    'google.cloud.monitoring_v3',
+    'google.cloud.resourcemanager_v3',
+    'google.api_core',
+    'googleapiclient.discovery',
+    'grpc',
+]
+
+# Directory the entry points are imported from
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+def time_command(command, runs):
+    """Runs a command `runs` times in a fresh interpreter and returns the median wall time in seconds."""
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=repo_dir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+def loaded_heavy_modules(module):
+    """Returns the heavy SDK modules that importing `module` pulls in."""
+    script = f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"
+    output = subprocess.run([sys.executable, '-c', script], cwd=repo_dir, check=True,
+                            capture_output=True, text=True).stdout
+    loaded = set(json.loads(output.splitlines()[-1]))
+    return [name for name in heavy_modules if name in loaded]
+
+def slowest_imports(module, limit=5):
+    """Returns the (cumulative microseconds, module) pairs of the slowest imports, from python -X importtime."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"], cwd=repo_dir,
+                            check=True, capture_output=True, text=True).stderr
+    timings = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            timings.append((int(parts[1]), parts[2].strip()))
+    return sorted(timings, reverse=True)[1:limit + 1]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long the entry points take to import and show --help.")
+    parser.add_argument('--runs', type=int, default=5, help="Runs per measurement (the median is reported)")
+    parser.add_argument('--max-import-seconds', type=float, default=0.3,
+                        help="Fail if importing an entry point takes longer than this beyond interpreter startup")
+    parser.add_argument('--show-imports', action='store_true', help="Also show the slowest imports of each entry point")
+    args = parser.parse_args()
+
+    # Interpreter startup is measured once and subtracted, so the budget only covers this repo's imports
+    baseline = time_command([sys.executable, '-c', 'pass'], args.runs)
+    print(f"Interpreter startup: {baseline * 1000:.0f} ms")
+    print(f"{'Entry point':40} {'import ms':>10} {'--help ms':>10}  heavy modules loaded")
+
+    failures = []
+    for module in entry_points:
+        import_seconds = time_command([sys.executable, '-c', f"import {module}"], args.runs) - baseline
+        help_seconds = time_command([sys.executable, f"{module}.py", '--help'], args.runs) - baseline
+        heavy = loaded_heavy_modules(module)
+        print(f"{module:40} {import_seconds * 1000:>10.0f} {help_seconds * 1000:>10.0f}  {', '.join(heavy) or '-'}")
+
+        if import_seconds > args.max_import_seconds:
+            failures.append(f"{module} took {import_seconds:.2f}s to import (budget {args.max_import_seconds:.2f}s)")
+        if heavy:
+            failures.append(f"{module} imports {', '.join(heavy)} at import time")
+        if args.show_imports:
+            for microseconds, name in slowest_imports(module):
+                print(f"    {name:50} {microseconds / 1000:>8.1f} ms")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
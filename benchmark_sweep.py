@@ -0,0 +1,166 @@
+import argparse
+import functools
+import importlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_gcp_server import (FakeFleet, FakeGcpServer, default_max_page_size, start_fake_monitoring_server,
+                             start_fake_server)
+
+# Scenarios run when none are named on the command line
+default_scenarios = ['sequential', 'concurrent', 'batch', 'metric_scripts']
+
+# Metric scripts and the counter each one exposes
+metric_scripts = {
+    'countofvpc_metric': 'count_vpcs',
+    'vpntunnel_count': 'count_vpn_tunnels',
+    'cloud_routerscount_metric': 'count_cloud_routers',
+    'dns_zonescount': 'count_dns_zones',
+}
+
+def percentile(values, fraction):
+    """Returns the value at `fraction` of the sorted values (nearest rank)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class JobTimer:
+    """Wraps counters so every call's duration is recorded, keeping the wrapped function's name."""
+
+    def __init__(self):
+        self.durations = []
+        self._lock = threading.Lock()
+
+    def wrap(self, counter):
+        @functools.wraps(counter)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return counter(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.durations.append(time.perf_counter() - start)
+        return timed
+
+def run_scenario(name, fake, projects, workers):
+    """Runs one scenario against the fake server and returns its throughput, latency and call counts."""
+    network_summary = importlib.import_module('withoutprojectfilters_networksummary')
+    from access_cache import AccessCache
+    from gcp_clients import get_metric_client
+    from metric_writer import MetricWriter
+    from run_report import RunReport
+    from sweep_executor import run_sweep
+
+    # Start every scenario from an empty report, no remembered denials and zeroed server counters; the
+    # denials go to a throwaway file so the fake projects never reach the user's access cache
+    network_summary.run_report = RunReport()
+    access_dir = tempfile.TemporaryDirectory()
+    access = AccessCache(os.path.join(access_dir.name, 'access_cache.sqlite'))
+    fake.reset_stats()
+    timer = JobTimer()
+    counters = [timer.wrap(counter) for counter in network_summary.build_counters(access=access)]
+
+    start = time.perf_counter()
+    if name == 'sequential':
+        run_sweep(projects, counters, max_workers=1)
+        jobs = len(projects) * len(counters)
+    elif name == 'concurrent':
+        run_sweep(projects, counters, max_workers=workers)
+        jobs = len(projects) * len(counters)
+    elif name == 'batch':
+        # The batched path has no per-job calls, so the whole sweep counts as one job
+        timer.wrap(network_summary.count_all_batched)(projects, access=access)
+        jobs = len(projects) * len(network_summary.counter_resources)
+    elif name == 'metric_scripts':
+        metric_writer = MetricWriter(get_metric_client(), projects[0], max_workers=workers)
+        script_counters = [timer.wrap(getattr(importlib.import_module(module), counter))
+                           for module, counter in metric_scripts.items()]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda job: job[0](metric_writer, job[1]),
+                              [(counter, project) for project in projects for counter in script_counters]))
+        timer.wrap(metric_writer.flush)()
+        jobs = len(projects) * len(script_counters)
+    else:
+        raise ValueError(f"Unknown scenario {name}")
+    elapsed = time.perf_counter() - start
+    access.close()
+    access_dir.cleanup()
+
+    stats = fake.stats()
+    return {
+        'scenario': name,
+        'projects': len(projects),
+        'jobs': jobs,
+        'seconds': round(elapsed, 3),
+        'jobs_per_second': round(jobs / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(timer.durations, 0.50) * 1000, 1),
+        'p99_ms': round(percentile(timer.durations, 0.99) * 1000, 1),
+        'api_calls': stats['requests'],
+        'injected_errors': stats['errors'],
+        'bytes_received': stats['bytes_sent'],
+        'time_series': stats['time_series'],
+        'operations': stats['operations'],
+    }
+
+def print_results(results):
+    """Prints one row per scenario followed by its per-operation call counts."""
+    columns = ['scenario', 'projects', 'jobs', 'seconds', 'jobs_per_second', 'p50_ms', 'p99_ms',
+               'api_calls', 'injected_errors', 'bytes_received']
+    print(' '.join(f"{column:>15}" for column in columns))
+    for result in results:
+        print(' '.join(f"{str(result[column]):>15}" for column in columns))
+    for result in results:
+        print(f"\n{result['scenario']} API calls:")
+        for operation, count in sorted(result['operations'].items()):
+            print(f"  {operation:45} {count}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the count scripts against a local fake of the GCP APIs.")
+    parser.add_argument('--projects', type=int, default=50, help="Number of projects in the fake fleet")
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds the fake server adds to every response")
+    parser.add_argument('--latency-jitter', type=float, default=0.01, help="Extra random latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of calls answered with 429/503")
+    parser.add_argument('--page-size', type=int, default=default_max_page_size,
+                        help="Largest page the fake server returns, to make list calls page with a small fleet")
+    parser.add_argument('--workers', type=int, default=16, help="Workers for the concurrent scenarios")
+    parser.add_argument('--scenario', action='append', choices=default_scenarios,
+                        help="Scenario to run (repeatable, defaults to all)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    # Keep the per-count log lines out of the results (basicConfig in the count modules is then a no-op)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    fake = FakeGcpServer(FakeFleet(args.projects, seed=args.seed), latency=args.latency,
+                         latency_jitter=args.latency_jitter, error_rate=args.error_rate, seed=args.seed,
+                         max_page_size=args.page_size)
+    http_server, url = start_fake_server(fake)
+    grpc_server, grpc_address = start_fake_monitoring_server(fake)
+
+    # Point every client at the fake server before the count modules create theirs
+    os.environ['GCP_API_ENDPOINT'] = url
+    os.environ['GCP_GRPC_ENDPOINT'] = grpc_address
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench-project-00000')
+    from rate_limit import get_governor, default_service_limits
+
+    # The fake server has no quota, so only the injected errors should slow the sweep down
+    for service in default_service_limits:
+        get_governor().configure(service, rate=100000, concurrency=args.workers * 4)
+
+    results = [run_scenario(name, fake, fake.fleet.project_ids(), args.workers)
+               for name in (args.scenario or default_scenarios)]
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    http_server.shutdown()
+    grpc_server.stop(None)
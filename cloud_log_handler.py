@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from gcp_clients import get_logging_client
+from rate_limit import get_governor
+from run_metrics import get_metrics
+
+# A batch is written once it holds this many entries or bytes, or its oldest entry is this old
+default_batch_entries = 500
+default_batch_bytes = 1024 * 1024
+default_flush_interval = 5.0
+
+# Most entries waiting to be written; further entries spill to disk (or are dropped) instead of blocking
+default_queue_size = 10000
+
+class BatchedCloudLoggingHandler(logging.Handler):
+    """Logging handler that writes structured entries to Cloud Logging in batches from a background thread.
+
+    emit() never waits on the network: entries go on a bounded queue, and when it is full they are
+    appended to `spill_path` (or dropped). Spilled entries, and batches that could not be written,
+    are sent again when the handler starts or closes. Fields passed as extra={'json_fields': {...}}
+    become part of the entry's JSON payload.
+    """
+
+    def __init__(self, log_name, level=logging.NOTSET, batch_entries=default_batch_entries,
+                 batch_bytes=default_batch_bytes, flush_interval=default_flush_interval,
+                 queue_size=default_queue_size, spill_path=None):
+        super().__init__(level)
+        self.log_name = log_name
+        self.batch_entries = batch_entries
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spill_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=f"cloud-logging-{log_name}", daemon=True)
+        self._thread.start()
+
+    def emit(self, record):
+        # Log records made while writing a batch (e.g. by the client library) must not feed back into the queue
+        if threading.current_thread() is self._thread or self._closed:
+            return
+        try:
+            entry = {
+                'payload': dict(getattr(record, 'json_fields', None) or {}, message=self.format(record),
+                                logger=record.name),
+                'severity': record.levelname,
+                'timestamp': record.created,
+            }
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            self._spill([entry])
+
+    def _spill(self, entries):
+        """Appends entries to the spill file, or drops them when there is none."""
+        if self.spill_path:
+            try:
+                with self._spill_lock, open(self.spill_path, 'a') as f:
+                    f.writelines(json.dumps(entry) + '\n' for entry in entries)
+                get_metrics().inc('log_entries', len(entries), outcome='spilled')
+                return
+            except OSError:
+                pass
+        get_metrics().inc('log_entries', len(entries), outcome='dropped')
+
+    def _write(self, entries):
+        """Writes one batch with a single entries.write call; returns True on success."""
+        try:
+            batch = get_logging_client().logger(self.log_name).batch()
+            for entry in entries:
+                batch.log_struct(entry['payload'], severity=entry['severity'],
+                                 timestamp=datetime.fromtimestamp(entry['timestamp'], timezone.utc))
+            get_governor().execute('logging', batch.commit)
+        except Exception as e:
+            logging.getLogger(__name__).warning(f"Could not write {len(entries)} log entries to {self.log_name}: {e}")
+            return False
+        get_metrics().inc('log_entries', len(entries), outcome='written')
+        return True
+
+    def _send(self, entries):
+        if entries and not self._write(entries):
+            self._spill(entries)
+
+    def _replay_spill(self):
+        """Sends the entries left in the spill file by an earlier run or a full queue."""
+        if not self.spill_path or not os.path.exists(self.spill_path):
+            return
+        with self._spill_lock:
+            replay_path = f"{self.spill_path}.replay"
+            try:
+                os.replace(self.spill_path, replay_path)
+            except OSError:
+                return
+        with open(replay_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        os.remove(replay_path)
+        for start in range(0, len(entries), self.batch_entries):
+            self._send(entries[start:start + self.batch_entries])
+
+    def _run(self):
+        self._replay_spill()
+        batch, batch_size, batch_started = [], 0, None
+        while True:
+            timeout = None if batch_started is None else max(0.0, batch_started + self.flush_interval - time.monotonic())
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+
+            # A flush marker or the stop marker writes whatever is pending
+            if isinstance(entry, threading.Event) or entry is _stop:
+                self._send(batch)
+                batch, batch_size, batch_started = [], 0, None
+                if entry is _stop:
+                    return
+                entry.set()
+                continue
+
+            if entry is not None:
+                batch.append(entry)
+                batch_size += len(json.dumps(entry['payload']))
+                if batch_started is None:
+                    batch_started = time.monotonic()
+            if batch and (len(batch) >= self.batch_entries or batch_size >= self.batch_bytes
+                          or time.monotonic() - batch_started >= self.flush_interval):
+                self._send(batch)
+                batch, batch_size, batch_started = [], 0, None
+
+    def flush(self, timeout=30):
+        """Waits until every entry queued so far has been written (or spilled)."""
+        if self._closed or not self._thread.is_alive():
+            return
+        flushed = threading.Event()
+        try:
+            self._queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return
+        flushed.wait(timeout)
+
+    def close(self, timeout=30):
+        """Writes every pending entry, retries spilled ones and stops the background thread."""
+        if not self._closed:
+            self._closed = True
+            try:
+                self._queue.put(_stop, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            self._replay_spill()
+        super().close()
+
+# Queued after the last entry to stop the background thread
+_stop = object()
@@ -0,0 +1,228 @@
+import argparse
+import heapq
+import itertools
+import logging
+import random
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import withoutprojectfilters_networksummary as network_summary
+from count_history import CountHistory, count_history_path
+from gcp_clients import get_storage_client
+from project_inventory import build_project_query, discover_projects
+from rate_limit import get_governor, parse_rate_limits
+from run_metrics import get_metrics
+from run_report import RunReport
+from sweep_executor import default_max_workers
+
+# Seconds between counts of each resource type in each project
+default_intervals = {
+    'firewall': 5 * 60,
+    'vpc': 15 * 60,
+    'vpc_peering': 15 * 60,
+    'private_service_access_range': 15 * 60,
+    'vpn_tunnel': 15 * 60,
+    'cloud_router': 15 * 60,
+    'dns_zone': 60 * 60,
+}
+
+# Interval of resource types not listed above
+default_interval = 15 * 60
+
+# Every reschedule is spread by up to this fraction of the interval so projects drift apart
+jitter_fraction = 0.1
+
+class CollectorDaemon:
+    """Runs the network summary counters on per-resource schedules, keeping clients and caches warm.
+
+    Each counter serves one shared listing, so it runs at the shortest interval of the resources it counts.
+    """
+
+    def __init__(self, list_projects, intervals=None, max_workers=default_max_workers,
+                 flush_interval=300, project_refresh_interval=3600, upload_report=True, publish=True,
+                 metrics_file=None, history_path=None):
+        self.list_projects = list_projects
+        self.intervals = dict(default_intervals, **(intervals or {}))
+        self.max_workers = max_workers
+        self.flush_interval = flush_interval
+        self.project_refresh_interval = project_refresh_interval
+        self.upload_report = upload_report
+        self.publish = publish
+        self.metrics_file = metrics_file
+        self.history_path = history_path
+
+        # Counter name -> counter function
+        self.counters = {counter.__name__: counter for counter in network_summary.counter_resources}
+
+        self._queue = []
+        self._sequence = itertools.count()
+        self._projects = set()
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _interval(self, name):
+        return min(self.intervals.get(resource, default_interval) for resource in self.counters[name].resources)
+
+    def _schedule(self, project, name, first=False):
+        """Queues the next run of a counter; first runs are spread across the whole interval."""
+        interval = self._interval(name)
+        if first:
+            delay = random.uniform(0, interval)
+        else:
+            delay = interval * random.uniform(1 - jitter_fraction, 1 + jitter_fraction)
+        heapq.heappush(self._queue, (time.monotonic() + delay, next(self._sequence), project, name))
+
+    def _refresh_projects(self):
+        """Schedules newly found projects; projects that disappeared are dropped when their jobs come due."""
+        try:
+            projects = set(self.list_projects())
+        except Exception as e:
+            logging.error(f"Error refreshing the project list, keeping {len(self._projects)} projects: {e}")
+            return
+        for project in sorted(projects - self._projects):
+            for name in self.counters:
+                self._schedule(project, name, first=True)
+        logging.info(f"Collecting from {len(projects)} projects "
+                     f"({len(projects - self._projects)} added, {len(self._projects - projects)} removed)")
+        self._projects = projects
+
+    def _submit(self, executor, project, name):
+        """Starts one count unless the previous count of the same job is still running."""
+        key = (project, name)
+        with self._in_flight_lock:
+            if key in self._in_flight:
+                logging.warning(f"Skipping {name} in {project}: previous count still running")
+                return
+            self._in_flight.add(key)
+
+        def done(future):
+            with self._in_flight_lock:
+                self._in_flight.discard(key)
+
+        executor.submit(self.counters[name], project).add_done_callback(done)
+
+    def flush(self):
+        """Writes the counts collected since the last flush to Cloud Storage and Cloud Monitoring."""
+        # Counters record into the module-level report, so swap in an empty one for the next cycle
+        report, network_summary.run_report = network_summary.run_report, RunReport()
+        if not report.records():
+            return
+
+        # A job that ran more than once in this window must be uploaded, published and kept only once
+        # (Cloud Monitoring rejects a request holding two points of one series)
+        report.keep_latest()
+        try:
+            if self.upload_report:
+                report.upload(get_storage_client(), network_summary.bucket_name,
+                              network_summary.report_prefix)
+            if self.publish:
+                network_summary.publish_metrics(report)
+        except Exception as e:
+            logging.error(f"Error flushing collected counts: {e}")
+
+        if self.history_path:
+            try:
+                history = CountHistory(self.history_path)
+                history.append(report)
+                history.compact()
+                history.close()
+            except sqlite3.Error as e:
+                logging.error(f"Error adding counts to the history in {self.history_path}: {e}")
+
+        # Current per-API limits, so backoff and recovery are visible while the daemon runs
+        for service, stats in get_governor().snapshot().items():
+            logging.info(f"API {service}: {stats}")
+        if self.metrics_file:
+            try:
+                get_metrics().write(self.metrics_file)
+            except OSError as e:
+                logging.error(f"Error writing runtime metrics to {self.metrics_file}: {e}")
+
+    def stop(self, signum=None, frame=None):
+        """Asks the main loop to finish in-flight counts, flush and exit."""
+        logging.info(f"Received signal {signum}, shutting down" if signum else "Shutting down")
+        self._stop.set()
+
+    def run(self):
+        """Runs until stop() is called, then drains in-flight counts and flushes once more."""
+        self._refresh_projects()
+        next_flush = time.monotonic() + self.flush_interval
+        next_refresh = time.monotonic() + self.project_refresh_interval
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self._stop.is_set():
+                now = time.monotonic()
+
+                # Start every job that has come due
+                while self._queue and self._queue[0][0] <= now:
+                    _, _, project, name = heapq.heappop(self._queue)
+                    if project not in self._projects:
+                        continue
+                    self._submit(executor, project, name)
+                    self._schedule(project, name)
+
+                if now >= next_flush:
+                    self.flush()
+                    next_flush = now + self.flush_interval
+                if now >= next_refresh:
+                    self._refresh_projects()
+                    next_refresh = now + self.project_refresh_interval
+
+                # Sleep until the next job, flush or refresh, waking early on shutdown
+                next_wakeup = min([next_flush, next_refresh] + ([self._queue[0][0]] if self._queue else []))
+                self._stop.wait(max(0.0, next_wakeup - time.monotonic()))
+
+            logging.info("Waiting for in-flight counts to finish")
+
+        self.flush()
+        for line in get_metrics().summary().splitlines():
+            logging.info(line)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collects network resource counts on a schedule.")
+    parser.add_argument('--project', action='append', default=[], help="Project to collect from (repeatable)")
+    parser.add_argument('--discover', action='store_true',
+                        help="Collect from every ACTIVE project found by Resource Manager")
+    parser.add_argument('--project-contains', help="With --discover, only collect from project IDs containing this text")
+    parser.add_argument('--interval', action='append', default=[], metavar='RESOURCE=SECONDS',
+                        help="Override the collection interval of a resource type (repeatable)")
+    parser.add_argument('--workers', type=int, default=default_max_workers, help="Concurrent counts")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='API=RATE[:CONCURRENCY]',
+                        help="Calls per second (and most concurrent calls) allowed for an API, e.g. compute=20:16")
+    parser.add_argument('--flush-interval', type=int, default=300,
+                        help="Seconds between report uploads and metric publishes")
+    parser.add_argument('--no-upload', action='store_true', help="Do not upload run reports to Cloud Storage")
+    parser.add_argument('--no-metrics', action='store_true', help="Do not publish counts to Cloud Monitoring")
+    parser.add_argument('--metrics-port', type=int, help="Serve runtime metrics for Prometheus on this port")
+    parser.add_argument('--metrics-file', help="Rewrite runtime metrics as OpenMetrics text here on every flush")
+    parser.add_argument('--history', nargs='?', const=count_history_path, metavar='PATH',
+                        help="Also add every flushed count to the local history database used by count_history.py")
+    args = parser.parse_args()
+
+    if args.discover:
+        # The inventory cache keeps repeated refreshes cheap
+        list_projects = lambda: discover_projects(query=build_project_query(), contains=args.project_contains)
+    else:
+        list_projects = lambda: args.project
+
+    for service, limit in parse_rate_limits(args.rate_limit).items():
+        get_governor().configure(service, rate=limit['rate'], concurrency=limit.get('concurrency'))
+
+    intervals = {resource: int(seconds) for resource, seconds in
+                 (interval.split('=', 1) for interval in args.interval)}
+
+    daemon = CollectorDaemon(list_projects, intervals=intervals, max_workers=args.workers,
+                             flush_interval=args.flush_interval, upload_report=not args.no_upload,
+                             publish=not args.no_metrics, metrics_file=args.metrics_file,
+                             history_path=args.history)
+    if args.metrics_port:
+        get_metrics().serve(args.metrics_port)
+
+    # Finish in-flight counts and flush on SIGTERM (e.g. from systemd or Kubernetes) and Ctrl-C
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
@@ -0,0 +1,234 @@
+import argparse
+import logging
+import os
+import re
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# Where every sweep's counts are kept for trend queries
+count_history_path = os.environ.get(
+    'COUNT_HISTORY_DB',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'history.sqlite')
+)
+
+# Raw points are kept this long; daily rollups for the second period; monthly rollups forever
+raw_retention = 35 * 24 * 60 * 60
+daily_retention = 400 * 24 * 60 * 60
+
+_schema = [
+    # One row per count; WITHOUT ROWID stores the rows in (project, resource, region, time) order
+    """CREATE TABLE IF NOT EXISTS points (
+           project_id TEXT, resource TEXT, region TEXT, ts INTEGER, count INTEGER,
+           PRIMARY KEY (project_id, resource, region, ts)) WITHOUT ROWID""",
+    # Daily and monthly summaries, kept up to date as points are added
+    """CREATE TABLE IF NOT EXISTS rollups (
+           project_id TEXT, resource TEXT, region TEXT, period TEXT, bucket INTEGER,
+           min_count INTEGER, max_count INTEGER, sum_count INTEGER, samples INTEGER,
+           last_ts INTEGER, last_count INTEGER,
+           PRIMARY KEY (project_id, resource, region, period, bucket)) WITHOUT ROWID""",
+    # Fleet-wide questions ("top projects by firewall count") start from the resource and the bucket
+    "CREATE INDEX IF NOT EXISTS rollups_by_bucket ON rollups (resource, region, period, bucket)",
+]
+
+_upsert_rollup = """
+    INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?)
+    ON CONFLICT (project_id, resource, region, period, bucket) DO UPDATE SET
+        min_count = MIN(min_count, excluded.min_count),
+        max_count = MAX(max_count, excluded.max_count),
+        sum_count = sum_count + excluded.sum_count,
+        samples = samples + 1,
+        last_count = CASE WHEN excluded.last_ts >= last_ts THEN excluded.last_count ELSE last_count END,
+        last_ts = MAX(last_ts, excluded.last_ts)"""
+
+def bucket_of(period, ts):
+    """Returns the start (epoch seconds, UTC) of the day or month holding `ts`."""
+    ts = int(ts)
+    if period == 'day':
+        return ts - ts % 86400
+    start = datetime.fromtimestamp(ts, timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return int(start.timestamp())
+
+def parse_time(value, now=None):
+    """Parses '90d', '12h', '2w' (that long ago), an ISO date or epoch seconds into epoch seconds."""
+    now = time.time() if now is None else now
+    match = re.fullmatch(r'(\d+)([smhdw])', value)
+    if match:
+        seconds = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}[match.group(2)]
+        return int(now - int(match.group(1)) * seconds)
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+def format_time(ts):
+    """Formats epoch seconds as a UTC date and time for the query output."""
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%d %H:%M')
+
+class CountHistory:
+    """Embedded SQLite store of every count over time, with daily and monthly rollups for long-range queries."""
+
+    def __init__(self, path=count_history_path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            for statement in _schema:
+                self._db.execute(statement)
+
+    def close(self):
+        self._db.close()
+
+    def append(self, report, timestamp=None):
+        """Adds every successful count of a run report as of `timestamp` (now by default); returns the number added."""
+        ts = int(time.time() if timestamp is None else timestamp)
+        added = 0
+        with self._db:
+            for record in report.records():
+                if record['error'] is not None or record['count'] is None:
+                    continue
+                key = (record['project_id'], record['resource'], record['region'] or '')
+                count = record['count']
+                # A report appended twice at the same time must not be counted twice in the rollups
+                if not self._db.execute("INSERT OR IGNORE INTO points VALUES (?, ?, ?, ?, ?)", key + (ts, count)).rowcount:
+                    continue
+                for period in ('day', 'month'):
+                    self._db.execute(_upsert_rollup, key + (period, bucket_of(period, ts), count, count, count, ts, count))
+                added += 1
+        logging.info(f"Added {added} counts to the history in {self.path}")
+        return added
+
+    def compact(self, now=None):
+        """Drops raw points and daily rollups past their retention; the coarser rollups already cover them."""
+        now = time.time() if now is None else now
+        with self._db:
+            points = self._db.execute("DELETE FROM points WHERE ts < ?",
+                                      (bucket_of('day', now - raw_retention),)).rowcount
+            days = self._db.execute("DELETE FROM rollups WHERE period = 'day' AND bucket < ?",
+                                    (bucket_of('month', now - daily_retention),)).rowcount
+        logging.info(f"Compacted the history: dropped {points} raw points and {days} daily rollups")
+        return {'points': points, 'days': days}
+
+    def _period_for(self, ts, now=None):
+        """Returns the finest rollup period still kept at `ts`."""
+        now = time.time() if now is None else now
+        return 'day' if ts >= now - daily_retention else 'month'
+
+    def series(self, project_id, resource, start, end=None, region='', period=None):
+        """Returns [(time, count)] for one project and resource, from raw points while they are kept,
+        otherwise from the last count of each day or month."""
+        end = time.time() if end is None else end
+        if period is None:
+            period = 'raw' if start >= time.time() - raw_retention else self._period_for(start)
+        if period == 'raw':
+            return self._db.execute(
+                "SELECT ts, count FROM points WHERE project_id = ? AND resource = ? AND region = ? "
+                "AND ts BETWEEN ? AND ? ORDER BY ts", (project_id, resource, region, start, end)).fetchall()
+        return self._db.execute(
+            "SELECT bucket, last_count FROM rollups WHERE project_id = ? AND resource = ? AND region = ? "
+            "AND period = ? AND bucket BETWEEN ? AND ? ORDER BY bucket",
+            (project_id, resource, region, period, bucket_of(period, start), end)).fetchall()
+
+    def _bucket_at(self, resource, region, period, at):
+        """Returns the latest bucket of `resource` at or before `at`, or None."""
+        row = self._db.execute("SELECT MAX(bucket) FROM rollups WHERE resource = ? AND region = ? AND period = ? "
+                               "AND bucket <= ?", (resource, region, period, bucket_of(period, at))).fetchone()
+        return row[0]
+
+    def top(self, resource, at=None, limit=10, region=''):
+        """Returns the [(project, count)] with the most `resource` on the day (or month) of `at`."""
+        at = time.time() if at is None else at
+        period = self._period_for(at)
+        bucket = self._bucket_at(resource, region, period, at)
+        return self._db.execute(
+            "SELECT project_id, last_count FROM rollups WHERE resource = ? AND region = ? AND period = ? "
+            "AND bucket = ? ORDER BY last_count DESC, project_id LIMIT ?",
+            (resource, region, period, bucket, limit)).fetchall()
+
+    def growth(self, resource, start, end=None, limit=10, region=''):
+        """Returns the [(project, count at start, count at end, change)] that grew the most between two times.
+
+        Projects without a count at the start (e.g. first counted later) are left out rather than taken as zero.
+        """
+        end = time.time() if end is None else end
+        # Both ends are compared at the same granularity, the finest one still kept at the start
+        period = self._period_for(start)
+        start_bucket = self._bucket_at(resource, region, period, start)
+        if start_bucket is None:
+            logging.warning(f"No {resource} counts as early as {format_time(start)}, so there is no growth to report")
+            return []
+        end_bucket = self._bucket_at(resource, region, period, end)
+        return self._db.execute(
+            "SELECT e.project_id, s.last_count, e.last_count, e.last_count - s.last_count AS change "
+            "FROM rollups e JOIN rollups s ON s.project_id = e.project_id AND s.resource = e.resource "
+            "AND s.region = e.region AND s.period = e.period AND s.bucket = ? "
+            "WHERE e.resource = ? AND e.region = ? AND e.period = ? AND e.bucket = ? "
+            "ORDER BY change DESC, e.project_id LIMIT ?",
+            (start_bucket, resource, region, period, end_bucket, limit)).fetchall()
+
+    def stats(self):
+        """Returns the row counts and time span of the store."""
+        points, first, last = self._db.execute("SELECT COUNT(*), MIN(ts), MAX(ts) FROM points").fetchone()
+        rollups = dict(self._db.execute("SELECT period, COUNT(*) FROM rollups GROUP BY period").fetchall())
+        oldest = self._db.execute("SELECT MIN(bucket) FROM rollups").fetchone()[0]
+        return {'points': points, 'first_point': first, 'last_point': last,
+                'day_rollups': rollups.get('day', 0), 'month_rollups': rollups.get('month', 0), 'oldest': oldest}
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Answers trend questions from the local count history.")
+    parser.add_argument('--db', default=count_history_path, help="History database written by the sweeps")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    series_parser = commands.add_parser('series', help="Counts of one resource in one project over time")
+    series_parser.add_argument('project')
+    series_parser.add_argument('resource')
+    series_parser.add_argument('--since', default='30d', help="Start, e.g. 90d, 2w or 2024-01-01")
+    series_parser.add_argument('--until', help="End (defaults to now)")
+    series_parser.add_argument('--region', default='', help="Region breakdown instead of the project total")
+    series_parser.add_argument('--period', choices=['raw', 'day', 'month'], help="Granularity (chosen from --since by default)")
+
+    top_parser = commands.add_parser('top', help="Projects with the most of a resource")
+    top_parser.add_argument('resource')
+    top_parser.add_argument('--at', help="As of this time (defaults to the latest day)")
+    top_parser.add_argument('--limit', type=int, default=10)
+    top_parser.add_argument('--region', default='')
+
+    growth_parser = commands.add_parser('growth', help="Projects whose count of a resource grew the most")
+    growth_parser.add_argument('resource')
+    growth_parser.add_argument('--since', default='90d')
+    growth_parser.add_argument('--until')
+    growth_parser.add_argument('--limit', type=int, default=10)
+    growth_parser.add_argument('--region', default='')
+
+    commands.add_parser('compact', help="Drop raw points and daily rollups past their retention")
+    commands.add_parser('stats', help="Show how much history is stored")
+    args = parser.parse_args()
+
+    history = CountHistory(args.db)
+    start_time = time.perf_counter()
+    if args.command == 'series':
+        rows = history.series(args.project, args.resource, parse_time(args.since),
+                              parse_time(args.until) if args.until else None, region=args.region, period=args.period)
+        for ts, count in rows:
+            print(f"{format_time(ts)}  {count}")
+    elif args.command == 'top':
+        rows = history.top(args.resource, parse_time(args.at) if args.at else None, args.limit, region=args.region)
+        for project_id, count in rows:
+            print(f"{project_id:40} {count:>10}")
+    elif args.command == 'growth':
+        rows = history.growth(args.resource, parse_time(args.since), parse_time(args.until) if args.until else None,
+                              args.limit, region=args.region)
+        print(f"{'Project':40} {'start':>10} {'end':>10} {'change':>10}")
+        for project_id, start_count, end_count, change in rows:
+            print(f"{project_id:40} {start_count:>10} {end_count:>10} {change:>+10}")
+    elif args.command == 'compact':
+        history.compact()
+    else:
+        for key, value in history.stats().items():
+            print(f"{key:15} {format_time(value) if key in ('first_point', 'last_point', 'oldest') and value else value}")
+    logging.info(f"{args.command} took {(time.perf_counter() - start_time) * 1000:.1f} ms")
@@ -1,8 +1,11 @@
+import argparse
 import logging
-from googleapiclient.discovery import build
-from google.auth import default
-from google.cloud import logging as cloud_logging
-from google.cloud import storage
+from access_cache import get_access_cache
+from cloud_log_handler import BatchedCloudLoggingHandler
+from gcp_clients import get_storage_client
+from resource_registry import make_counter, plan_listings
+from run_report import RunReport
+from sweep_executor import default_max_workers, run_sweep
 
 # Configure logging to send logs to the console and a log sink
 logging.basicConfig(
@@ -20,148 +23,56 @@ projects = [
     'tfci-hst-tst-6'
 ]
 
-# Configure Cloud Logging
-logging_client = cloud_logging.Client()
-logger = logging_client.logger('vpn-tunnel-count')  # Replace with your desired logger name
+# Resource types counted in each project
+resources = ['vpn_tunnel', 'vpc', 'dns_zone', 'cloud_router']
 
-# Configure Cloud Storage
-storage_client = storage.Client()
-bucket_name = 'metric-count'  # Replace with your Cloud Storage bucket name
-blob_name = 'vpn_tunnel_counts.txt'  # Replace with your desired blob name
-
-def count_vpn_tunnels(target_project_id):
-    """Counts VPN Tunnels in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # Specify the region for VPN Tunnels
-        region = 'us-central1'  # Replace with your actual region
-
-        # List VPN Tunnels in the target project and region
-        response = service.vpnTunnels().list(project=target_project_id, region=region).execute()
-        vpn_tunnel_count = len(response.get('items', []))
-
-        # Log the VPN Tunnel count to Cloud Logging
-        logger.log_text(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}")
-
-        # Write the VPN Tunnel count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}\n",
-                                 content_type='text/plain')
-
-        # Log the VPN Tunnel count to the console
-        logging.info(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}")
-
-    except Exception as e:
-        # Log the error to Cloud Logging
-        logger.log_text(f"Error counting VPN Tunnels in {target_project_id}: {e}")
-
-        # Log the error to the console
-        logging.error(f"Error counting VPN Tunnels in {target_project_id}: {e}")
-
-def count_vpcs(target_project_id):
-    """Counts VPCs in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # List VPCs in the target project
-        response = service.networks().list(project=target_project_id).execute()
-        vpc_count = len(response.get('items', []))
-
-        # Log the VPC count to Cloud Logging
-        logger.log_text(f"VPC Count in {target_project_id}: {vpc_count}")
-
-        # Write the VPC count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPC Count in {target_project_id}: {vpc_count}\n",
-                                 content_type='text/plain')
-
-        # Log the VPC count to the console
-        logging.info(f"VPC Count in {target_project_id}: {vpc_count}")
+# Configure Cloud Logging (the handler writes entries in batches from a background thread)
+log_name = 'vpn-tunnel-count'  # Replace with your desired logger name
+log_spill_path = 'vpn-tunnel-count.spill.jsonl'  # Entries that could not be queued or written wait here
 
-    except Exception as e:
-        # Log the error to Cloud Logging
-        logger.log_text(f"Error counting VPCs in {target_project_id}: {e}")
+# Count entries go to Cloud Logging only (once a handler is attached); the console gets one line per count
+cloud_logger = logging.getLogger(log_name)
+cloud_logger.propagate = False
 
-        # Log the error to the console
-        logging.error(f"Error counting VPCs in {target_project_id}: {e}")
-
-def count_dns_zones(target_project_id):
-    """Counts DNS Zones in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the DNS service
-        service = build('dns', 'v1', credentials=credentials)
-
-        # List DNS Zones in the target project
-        response = service.managedZones().list(project=target_project_id).execute()
-        dns_zone_count = len(response.get('managedZones', []))
-
-        # Log the DNS Zone count to Cloud Logging
-        logger.log_text(f"DNS Zone Count in {target_project_id}: {dns_zone_count}")
-
-        # Write the DNS Zone count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"DNS Zone Count in {target_project_id}: {dns_zone_count}\n",
-                                 content_type='text/plain')
-
-        # Log the DNS Zone count to the console
-        logging.info(f"DNS Zone Count in {target_project_id}: {dns_zone_count}")
-
-    except Exception as e:
-        # Log the error to Cloud Logging
-        logger.log_text(f"Error counting DNS Zones in {target_project_id}: {e}")
-
-        # Log the error to the console
-        logging.error(f"Error counting DNS Zones in {target_project_id}: {e}")
-
-def count_cloud_routers(target_project_id):
-    """Counts Cloud Routers in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # Specify the region for Cloud Routers
-        region = 'us-central1'  # Replace with your actual region
-
-        # List Cloud Routers in the target project and region
-        response = service.routers().list(project=target_project_id, region=region).execute()
-        cloud_router_count = len(response.get('items', []))
-
-        # Log the Cloud Router count to Cloud Logging
-        logger.log_text(f"Cloud Router Count in {target_project_id}: {cloud_router_count}")
-
-        # Write the Cloud Router count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"Cloud Router Count in {target_project_id}: {cloud_router_count}\n",
-                                 content_type='text/plain')
-
-        # Log the Cloud Router count to the console
-        logging.info(f"Cloud Router Count in {target_project_id}: {cloud_router_count}")
+# Configure Cloud Storage (the client is created when the report is uploaded)
+bucket_name = 'metric-count'  # Replace with your Cloud Storage bucket name
+report_prefix = 'network-summary'  # Each run writes one report object under this prefix
 
-    except Exception as e:
-        # Log the error to Cloud Logging
-        logger.log_text(f"Error counting Cloud Routers in {target_project_id}: {e}")
+# Every count made during this run, written to Cloud Storage as one object at the end
+run_report = RunReport()
 
-        # Log the error to the console
-        logging.error(f"Error counting Cloud Routers in {target_project_id}: {e}")
+def log_count_lines(lines, level=logging.INFO, fields=None):
+    """Queues a counter's result for Cloud Logging as one structured entry and writes its lines to the console."""
+    cloud_logger.log(level, "\n".join(lines), extra={'json_fields': fields or {}})
+    for line in lines:
+        logging.log(level, line)
 
 if __name__ == "__main__":
-    for project in projects:
-        count_vpn_tunnels(project)  # Count VPN Tunnels in each project
-        count_vpcs(project)  # Count VPCs in each project
-        count_dns_zones(project)  # Count DNS Zones in each project
-        count_cloud_routers(project)  # Count Cloud Routers in each project
+    parser = argparse.ArgumentParser(description="Counts network resources in each project.")
+    parser.add_argument('--workers', type=int, default=default_max_workers,
+                        help="Maximum number of (project, resource) counts to run at the same time")
+    parser.add_argument('--report-format', choices=['jsonl', 'csv'], default='jsonl',
+                        help="Format of the run report written to Cloud Storage")
+    parser.add_argument('--gzip', action='store_true', help="Gzip the run report")
+    parser.add_argument('--log-spill', default=log_spill_path,
+                        help="File holding log entries that could not be queued or written, sent again on the next run")
+    args = parser.parse_args()
+
+    # Batch the per-count entries instead of paying one Cloud Logging call per count
+    cloud_handler = BatchedCloudLoggingHandler(log_name, spill_path=args.log_spill)
+    cloud_logger.addHandler(cloud_handler)
+
+    # Counters to run for each project, compiled from the resource registry; projects where an API is
+    # known to be disabled or denied are skipped
+    counters = [make_counter(listing, run_report.record, log=log_count_lines, access=get_access_cache())
+                for listing in plan_listings(resources)]
+
+    # Run every (project, counter) job concurrently on a bounded worker pool
+    run_sweep(projects, counters, max_workers=args.workers)
+
+    # Write every count from this run to Cloud Storage in one upload
+    run_report.upload(get_storage_client(), bucket_name, report_prefix, fmt=args.report_format, compress=args.gzip)
+
+    # Send the last batch of log entries before exiting
+    cloud_logger.removeHandler(cloud_handler)
+    cloud_handler.close()
@@ -1,23 +1,91 @@
-from google.cloud import monitoring_v3
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.api_core.exceptions import GoogleAPICallError
+from gcp_clients import get_metric_client
+from metric_registry import forget_metric_descriptors
+from rate_limit import get_governor
+
+def _type_filter(type_prefixes):
+    """Builds a Monitoring filter matching any of the metric type prefixes (a trailing * is optional)."""
+    clauses = [f'metric.type = starts_with("{prefix.rstrip("*")}")' for prefix in type_prefixes]
+    return " OR ".join(clauses)
+
+def plan_custom_metric_deletions(client, project_ids, type_prefixes):
+    """Lists the descriptors to delete, letting the server apply the type prefix filter."""
+    plan = []
+    for project_id in project_ids:
+        request = {'name': f"projects/{project_id}", 'filter': _type_filter(type_prefixes)}
+        for descriptor in client.list_metric_descriptors(request=request):
+            plan.append((project_id, descriptor.name))
+    return plan
+
+def bulk_delete_custom_metrics(project_ids, type_prefixes=("custom.googleapis.com/",), dry_run=False,
+                               max_workers=8, rate=10):
+    """Deletes matching custom metric descriptors in several projects concurrently under a rate limit."""
+    client = get_metric_client()
+
+    plan = plan_custom_metric_deletions(client, project_ids, type_prefixes)
+    if dry_run:
+        for project_id, name in plan:
+            print(f"Would delete custom metric: {name}")
+        print(f"Dry run: {len(plan)} custom metrics would be deleted in {len(project_ids)} projects")
+        return {'planned': len(plan), 'deleted': 0, 'failed': 0}
+
+    # Deletes go through the Monitoring governor, capped at `rate` per second and `max_workers` at a time,
+    # which also retries the ones rejected for quota
+    get_governor().configure('monitoring', rate=rate, concurrency=max_workers)
+
+    def delete(item):
+        project_id, name = item
+        try:
+            get_governor().execute('monitoring', lambda: client.delete_metric_descriptor(name=name))
+            print(f"Deleted custom metric: {name}")
+            return True
+        except GoogleAPICallError as e:
+            print(f"Error deleting custom metric {name}: {e}")
+            return False
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        outcomes = list(executor.map(delete, plan))
+    elapsed = time.monotonic() - started
+
+    # Summarize what was removed per project and the throughput achieved
+    deleted_per_project = {}
+    for (project_id, name), deleted in zip(plan, outcomes):
+        if deleted:
+            deleted_per_project.setdefault(project_id, []).append(name.split('/metricDescriptors/', 1)[-1])
+    for project_id in project_ids:
+        print(f"Deleted {len(deleted_per_project.get(project_id, []))} custom metrics in {project_id}")
+
+        # Deleted descriptors must not stay "reconciled" in the local cache, or they would not be recreated
+        forget_metric_descriptors(project_id, deleted_per_project.get(project_id, []))
+
+    deleted = sum(outcomes)
+    throughput = deleted / elapsed if elapsed > 0 else 0.0
+    print(f"Deleted {deleted} of {len(plan)} custom metrics in {elapsed:.1f}s ({throughput:.1f}/s)")
+    return {'planned': len(plan), 'deleted': deleted, 'failed': len(plan) - deleted}
 
 def delete_custom_metrics(project_id):
     """Deletes all custom metrics in the specified project."""
     try:
-        # Authenticate with Google Cloud
-        client = monitoring_v3.MetricServiceClient()
-        project_name = f"projects/{project_id}"
-
-        # List all custom metrics
-        for descriptor in client.list_metric_descriptors(name=project_name):
-            # Check if the metric type starts with "custom.googleapis.com/"
-            if descriptor.type.startswith("custom.googleapis.com/"):
-                # Delete the custom metric
-                client.delete_metric_descriptor(name=descriptor.name)
-                print(f"Deleted custom metric: {descriptor.name}")
+        bulk_delete_custom_metrics([project_id])
 
     except Exception as e:
         print(f"Error deleting custom metrics: {e}")
 
 if __name__ == "__main__":
-    project_id = "eighth-duality-429108-h0"  # Replace with your project ID
-    delete_custom_metrics(project_id)
+    parser = argparse.ArgumentParser(description="Deletes custom metric descriptors.")
+    parser.add_argument('projects', nargs='*', default=["eighth-duality-429108-h0"],  # Replace with your project IDs
+                        help="Projects to clean up")
+    parser.add_argument('--prefix', action='append', dest='prefixes',
+                        help="Metric type prefix to delete (repeatable, default custom.googleapis.com/)")
+    parser.add_argument('--dry-run', action='store_true', help="Only print what would be deleted")
+    parser.add_argument('--workers', type=int, default=8, help="Concurrent delete calls")
+    parser.add_argument('--rate', type=float, default=10, help="Maximum delete calls per second")
+    args = parser.parse_args()
+
+    bulk_delete_custom_metrics(args.projects, args.prefixes or ["custom.googleapis.com/"],
+                               dry_run=args.dry_run, max_workers=args.workers, rate=args.rate)
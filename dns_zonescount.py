@@ -1,88 +1,46 @@
-from google.cloud import monitoring_v3
-from google.api import metric_pb2 as ga_metric
-from google.api import label_pb2 as ga_label
-from googleapiclient.discovery import build
-from google.auth import default
-from google.protobuf.timestamp_pb2 import Timestamp
+from google.api_core.exceptions import GoogleAPICallError
+from gcp_clients import get_default_project_id, get_metric_client
+from metric_registry import ensure_metric_descriptors, metric_type
+from metric_writer import MetricWriter
+from resource_registry import count_resource
 
 def create_custom_metric():
-    """Creates a custom metric for DNS Zone count in Cloud Monitoring."""
+    """Makes sure the custom metric for DNS Zone count exists in Cloud Monitoring with the registered schema."""
     try:
-        # Authenticate with Google Cloud
-        credentials, project_id = default()
+        # Use the project that came with the default credentials
+        project_id = get_default_project_id()
 
-        # Create the Monitoring client
-        client = monitoring_v3.MetricServiceClient()
-        project_name = f"projects/{project_id}"
+        # Get the shared Monitoring client
+        client = get_metric_client()
 
-        # Construct the MetricDescriptor
-        descriptor = ga_metric.MetricDescriptor(
-            type="custom.googleapis.com/dns_zone_count",
-            metric_kind=ga_metric.MetricDescriptor.MetricKind.GAUGE,
-            value_type=ga_metric.MetricDescriptor.ValueType.INT64,
-            description="DNS Zone Count in the project",
-            display_name="DNS Zone Count",
-            labels=[
-                ga_label.LabelDescriptor(
-                    key="project_id",
-                    value_type=ga_label.LabelDescriptor.ValueType.STRING,
-                    description="ID of the GCP Project"
-                )
-            ]
-        )
+        # Reconcile against the registry; a recent cached check skips the API call entirely
+        ensure_metric_descriptors(client, project_id, ['dns_zone_count'])
 
-        # Create the metric descriptor
-        descriptor = client.create_metric_descriptor(name=project_name, metric_descriptor=descriptor)
-        print(f"Created custom metric: {descriptor.name}")
-
-    except Exception as e:
+    except GoogleAPICallError as e:
         print(f"Error creating custom metric: {e}")
 
-def count_dns_zones():
-    """Counts DNS Zones in the project and writes the count to the custom metric."""
+def count_dns_zones(metric_writer, target_project_id):
+    """Counts DNS Zones in the target project and queues the count for the custom metric."""
     try:
-        # Authenticate with Google Cloud
-        credentials, project_id = default()
-
-        # Build the DNS service
-        service = build('dns', 'v1', credentials=credentials)
-
-        # List DNS Zones in the project
-        response = service.managedZones().list(project=project_id).execute()
-        dns_zone_count = len(response.get('managedZones', []))
-
-        # Create the Monitoring client
-        client = monitoring_v3.MetricServiceClient()
-        project_name = f"projects/{project_id}"
-
-        # Prepare the custom metric data
-        series = monitoring_v3.TimeSeries()
-        series.metric.type = "custom.googleapis.com/dns_zone_count"  # Your custom metric type
-        series.resource.type = "global"
+        # List DNS Zones in the project with the registry's listing
+        dns_zone_count = count_resource('dns_zone', target_project_id)['count']
 
-        # Initialize the point and interval
-        point = monitoring_v3.Point()
-        point.value.int64_value = dns_zone_count
+        # Queue the count for the batched metric writer
+        metric_writer.add(metric_type('dns_zone_count'), dns_zone_count, target_project_id)
 
-        # Get the current time
-        now = Timestamp()
-        now.GetCurrentTime()
-
-        # Set the same start and end time for gauge metric
-        interval = monitoring_v3.TimeInterval(end_time=now, start_time=now)
-        point.interval = interval
-
-        # Append the point to the series
-        series.points.append(point)
-
-        # Send the data to Cloud Monitoring
-        client.create_time_series(name=project_name, time_series=[series])
-
-        print(f"DNS Zone Count: {dns_zone_count}")
+        print(f"DNS Zone Count in {target_project_id}: {dns_zone_count}")
 
     except Exception as e:
-        print(f"Error: {e}")
+        print(f"Error counting DNS Zones in {target_project_id}: {e}")
 
 if __name__ == "__main__":
-    create_custom_metric()  # Create the custom metric first
-    count_dns_zones()  # Then count DNS Zones and write to the metric
+    create_custom_metric()  # Make sure the custom metric exists first
+
+    # Define the projects you want to monitor (the project of the default credentials by default)
+    projects = [get_default_project_id()]
+
+    # Points for every project are written together, with a project_id label on each
+    metric_writer = MetricWriter(get_metric_client(), get_default_project_id())
+    for project in projects:
+        count_dns_zones(metric_writer, project)  # Count DNS Zones and queue the metric point
+    metric_writer.flush()  # Then write all points to the metric
@@ -0,0 +1,595 @@
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Regions the fake regional resources are spread across
+fake_regions = [
+    'us-central1', 'us-east1', 'us-west1', 'europe-west1',
+    'europe-west4', 'asia-east1', 'asia-southeast1', 'australia-southeast1',
+]
+
+# Average number of items per project for each resource type
+default_resource_counts = {
+    'networks': 4,
+    'firewalls': 40,
+    'globalAddresses': 6,
+    'routers': 4,
+    'vpnTunnels': 6,
+    'subnetworks': 20,
+    'forwardingRules': 10,
+    'managedZones': 5,
+    'services': 2,
+}
+
+# Cloud Asset Inventory type of each fleet resource, with the service and collection of its full resource name
+fake_asset_types = {
+    'networks': ('compute.googleapis.com/Network', 'compute', 'networks'),
+    'firewalls': ('compute.googleapis.com/Firewall', 'compute', 'firewalls'),
+    'globalAddresses': ('compute.googleapis.com/GlobalAddress', 'compute', 'addresses'),
+    'routers': ('compute.googleapis.com/Router', 'compute', 'routers'),
+    'vpnTunnels': ('compute.googleapis.com/VpnTunnel', 'compute', 'vpnTunnels'),
+    'subnetworks': ('compute.googleapis.com/Subnetwork', 'compute', 'subnetworks'),
+    'forwardingRules': ('compute.googleapis.com/ForwardingRule', 'compute', 'forwardingRules'),
+    'managedZones': ('dns.googleapis.com/ManagedZone', 'dns', 'managedZones'),
+}
+
+# Largest page any list endpoint returns by default, whatever page size is asked for
+default_max_page_size = 500
+
+class FakeFleet:
+    """A deterministic fleet whose resources are generated on demand, so 10k projects cost no memory."""
+
+    def __init__(self, project_count=100, resource_counts=None, seed=0,
+                 large_project_fraction=0.01, large_project_factor=50, disabled_api_fraction=0.0):
+        self.project_count = project_count
+        self.resource_counts = dict(default_resource_counts, **(resource_counts or {}))
+        self.seed = seed
+        self.large_project_fraction = large_project_fraction
+        self.large_project_factor = large_project_factor
+        self.disabled_api_fraction = disabled_api_fraction
+
+    def project_ids(self):
+        return [f"bench-project-{index:05d}" for index in range(self.project_count)]
+
+    def _random(self, *parts):
+        digest = hashlib.sha256(repr((self.seed,) + parts).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def api_enabled(self, project_id, api):
+        """Every project has Compute Engine enabled; other APIs are disabled in a share of the projects."""
+        return api == 'compute' or self._random(project_id, 'enabled', api).random() >= self.disabled_api_fraction
+
+    def item_count(self, project_id, resource):
+        """Number of items of a resource type in a project; a few projects are much larger than the rest."""
+        rng = self._random(project_id, resource)
+        mean = self.resource_counts.get(resource, 0)
+        if self._random(project_id).random() < self.large_project_fraction:
+            mean *= self.large_project_factor
+        return max(0, int(rng.gauss(mean, mean / 3))) if mean else 0
+
+    def item(self, project_id, resource, index):
+        """Builds one resource body with the fields the counters look at."""
+        compute = f"https://www.googleapis.com/compute/v1/projects/{project_id}"
+        network_count = max(1, self.item_count(project_id, 'networks'))
+        item = {
+            'name': f"{resource.lower()}-{index}",
+            'id': str(int.from_bytes(hashlib.sha256(f"{project_id}/{resource}/{index}".encode()).digest()[:8], 'big')),
+        }
+        if resource in ('routers', 'vpnTunnels', 'subnetworks', 'forwardingRules'):
+            item['region'] = f"{compute}/regions/{fake_regions[index % len(fake_regions)]}"
+        if resource in ('firewalls', 'routers', 'subnetworks', 'globalAddresses', 'forwardingRules'):
+            item['network'] = f"{compute}/global/networks/networks-{index % network_count}"
+        if resource == 'firewalls':
+            item['direction'] = 'EGRESS' if index % 3 == 0 else 'INGRESS'
+        elif resource == 'vpnTunnels':
+            item['status'] = ['ESTABLISHED', 'ESTABLISHED', 'ESTABLISHED', 'NO_INCOMING_PACKETS'][index % 4]
+        elif resource == 'managedZones':
+            item['visibility'] = 'private' if index % 2 else 'public'
+            item['dnsName'] = f"zone{index}.example.com."
+        elif resource == 'globalAddresses':
+            item['purpose'] = 'VPC_PEERING' if index % 2 == 0 else 'PRIVATE_SERVICE_CONNECT'
+        elif resource == 'networks':
+            item['peerings'] = [
+                {'name': f"peering-{index}-{peer}", 'network': f"{compute}/global/networks/peer-{peer}", 'state': 'ACTIVE'}
+                for peer in range(index % 3)
+            ]
+        return item
+
+    def items(self, project_id, resource):
+        return [self.item(project_id, resource, index) for index in range(self.item_count(project_id, resource))]
+
+    def asset(self, project_id, resource, index, with_resource=False):
+        """Builds the searchAllResources result of one item."""
+        item = self.item(project_id, resource, index)
+        asset_type, service, collection = fake_asset_types[resource]
+        region = item['region'].split('/')[-1] if 'region' in item else None
+        if service == 'dns':
+            path = f"projects/{project_id}/managedZones/{item['name']}"
+        elif region:
+            path = f"projects/{project_id}/regions/{region}/{collection}/{item['name']}"
+        else:
+            path = f"projects/{project_id}/global/{collection}/{item['name']}"
+        asset = {'name': f"//{service}.googleapis.com/{path}", 'assetType': asset_type,
+                 'location': region or 'global', 'displayName': item['name']}
+        if with_resource:
+            asset['versionedResources'] = [{'version': 'v1', 'resource': item}]
+        return asset
+
+    def assets(self, project_ids, asset_types, offset, limit, with_resource=False):
+        """Returns up to `limit` search results starting at `offset`, skipping whole projects without building them."""
+        resources = [resource for resource, (asset_type, _, _) in fake_asset_types.items()
+                     if not asset_types or asset_type in asset_types]
+        assets = []
+        position = 0
+        for project_id in project_ids:
+            for resource in resources:
+                count = self.item_count(project_id, resource)
+                if position + count <= offset:
+                    position += count
+                    continue
+                for index in range(max(0, offset - position), count):
+                    if len(assets) == limit:
+                        return assets, True
+                    assets.append(self.asset(project_id, resource, index, with_resource))
+                position += count
+        return assets, False
+
+def _filter_items(items, filter_expression):
+    """Applies simple 'field = "value"' list filters, the only kind the counters send."""
+    if not filter_expression:
+        return items
+    match = re.match(r'\s*(\w+)\s*=\s*"?([^"]*)"?\s*$', filter_expression)
+    if not match:
+        return items
+    field, value = match.groups()
+    return [item for item in items if str(item.get(field)) == value]
+
+def _page(items, query, page_size_param='maxResults', max_page_size=default_max_page_size):
+    """Returns one page of items and the token of the next page, if any."""
+    offset = int(query.get('pageToken', ['0'])[0] or 0)
+    page_size = min(int(query.get(page_size_param, [max_page_size])[0]), max_page_size)
+    next_offset = offset + page_size
+    return items[offset:next_offset], (str(next_offset) if next_offset < len(items) else None)
+
+def _parse_fields(fields):
+    """Parses a partial-response field mask, e.g. 'items/*/vpnTunnels(name,status),nextPageToken', into
+    a tree of {field: subtree}, where a None subtree keeps the whole value and '*' matches every key."""
+    def parse(pos):
+        tree = {}
+        while pos < len(fields) and fields[pos] != ')':
+            match = re.compile(r'[^,()]*').match(fields, pos)
+            path, pos = match.group().strip().split('/'), match.end()
+            subtree = None
+            if pos < len(fields) and fields[pos] == '(':
+                subtree, pos = parse(pos + 1)
+                pos += 1
+            # a/b/c selects c inside b inside a, unless all of a or b is already selected
+            node = tree
+            for part in path[:-1]:
+                node = node.setdefault(part, {}) if node is not None else None
+            if node is not None:
+                node[path[-1]] = subtree
+            if pos < len(fields) and fields[pos] == ',':
+                pos += 1
+        return tree, pos
+    return parse(0)[0]
+
+def _select_fields(value, tree):
+    """Keeps the parts of a response selected by a _parse_fields tree, like the real APIs' `fields` parameter."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [_select_fields(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    selected = {}
+    for key, subtree in tree.items():
+        for name in (value if key == '*' else [key] if key in value else []):
+            selected[name] = _select_fields(value[name], subtree)
+    return selected
+
+class FakeGcpServer:
+    """In-process stand-in for the Google APIs the count scripts call, with latency, paging and error injection."""
+
+    def __init__(self, fleet=None, latency=0.0, latency_jitter=0.0, error_rate=0.0, seed=0, asset_recording=None,
+                 max_page_size=default_max_page_size):
+        self.fleet = fleet or FakeFleet()
+        # Largest page returned, so small fleets can still be made to page
+        self.max_page_size = max_page_size
+        # Recorded searchAllResources results to serve instead of the generated fleet's assets
+        self.asset_recording = asset_recording
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._descriptors = {}
+        self._uploads = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'requests': 0, 'errors': 0, 'bytes_sent': 0, 'time_series': 0, 'operations': {}}
+
+    def stats(self):
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def _count(self, operation, bytes_sent=0):
+        with self._lock:
+            self._stats['requests'] += 1
+            self._stats['bytes_sent'] += bytes_sent
+            self._stats['operations'][operation] = self._stats['operations'].get(operation, 0) + 1
+
+    def delay(self):
+        """Sleeps for the simulated network and server latency of one call."""
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _inject_error(self):
+        """Returns an error response for a share of requests, as a quota error or a transient outage."""
+        with self._lock:
+            if self.error_rate <= 0 or self._random.random() >= self.error_rate:
+                return None
+            self._stats['errors'] += 1
+            status = 429 if self._random.random() < 0.5 else 503
+        reason = 'rateLimitExceeded' if status == 429 else 'backendError'
+        body = json.dumps({'error': {'code': status, 'message': reason, 'errors': [{'reason': reason}]}})
+        return status, {'Content-Type': 'application/json', 'Retry-After': '0'}, body.encode()
+
+    def _service_disabled(self, operation, api, project_id):
+        """Returns the 403 Google APIs send for calls to an API that is not enabled in the project."""
+        message = (f"{api} API has not been used in project {project_id} before or it is disabled. "
+                   f"Enable it by visiting https://console.developers.google.com/apis/api/{api}.googleapis.com/overview")
+        return self._json(operation, {'error': {
+            'code': 403, 'message': message, 'status': 'PERMISSION_DENIED',
+            'errors': [{'message': message, 'domain': 'usageLimits', 'reason': 'accessNotConfigured'}],
+            'details': [{'@type': 'type.googleapis.com/google.rpc.ErrorInfo', 'reason': 'SERVICE_DISABLED',
+                         'domain': 'googleapis.com', 'metadata': {'service': f"{api}.googleapis.com"}}],
+        }}, status=403)
+
+    def _page(self, items, query, page_size_param='maxResults'):
+        return _page(items, query, page_size_param, self.max_page_size)
+
+    def _json(self, operation, payload, status=200, headers=None, fields=None):
+        # Successful responses only carry the fields asked for, so field masks shrink them as they would for real
+        if fields and status == 200:
+            payload = _select_fields(payload, _parse_fields(fields))
+        body = json.dumps(payload).encode()
+        self._count(operation, len(body))
+        return status, dict({'Content-Type': 'application/json'}, **(headers or {})), body
+
+    def route(self, method, path, query, body, headers, base_url=''):
+        """Handles one API call and returns (status, headers, body)."""
+        error = self._inject_error()
+        if error is not None:
+            return error
+
+        fleet = self.fleet
+        fields = query.get('fields', [None])[0]
+
+        match = re.search(r'/projects/([^/]+)/global/(\w+)$', path)
+        if method == 'GET' and match:
+            project_id, collection = match.groups()
+            # Global addresses live under /global/addresses but are a separate resource from regional ones
+            resource = 'globalAddresses' if collection == 'addresses' else collection
+            items, token = self._page(_filter_items(fleet.items(project_id, resource), query.get('filter', [''])[0]), query)
+            return self._json(f"compute.{resource}.list", dict({'items': items}, **({'nextPageToken': token} if token else {})),
+                              fields=fields)
+
+        match = re.search(r'/projects/([^/]+)/aggregated/(\w+)$', path)
+        if method == 'GET' and match:
+            project_id, resource = match.groups()
+            items, token = self._page(fleet.items(project_id, resource), query)
+            scoped = {}
+            for item in items:
+                scope = 'regions/' + item['region'].split('/')[-1]
+                scoped.setdefault(scope, {resource: []})[resource].append(item)
+            return self._json(f"compute.{resource}.aggregatedList",
+                              dict({'items': scoped}, **({'nextPageToken': token} if token else {})), fields=fields)
+
+        match = re.search(r'/projects/([^/]+)/regions/([^/]+)/(\w+)$', path)
+        if method == 'GET' and match:
+            project_id, region, resource = match.groups()
+            regional = [item for item in fleet.items(project_id, resource) if item['region'].endswith(f"/{region}")]
+            items, token = self._page(regional, query)
+            return self._json(f"compute.{resource}.list", dict({'items': items}, **({'nextPageToken': token} if token else {})),
+                              fields=fields)
+
+        match = re.search(r'/projects/([^/]+)/managedZones$', path)
+        if method == 'GET' and match:
+            if not fleet.api_enabled(match.group(1), 'dns'):
+                return self._service_disabled('dns.managedZones.list', 'dns', match.group(1))
+            items, token = self._page(fleet.items(match.group(1), 'managedZones'), query)
+            return self._json('dns.managedZones.list',
+                              dict({'managedZones': items}, **({'nextPageToken': token} if token else {})), fields=fields)
+
+        match = re.search(r'/v1/projects/([^/]+)/services:batchGet$', path)
+        if method == 'GET' and match:
+            project_id = match.group(1)
+            services = [
+                {'name': name, 'state': 'ENABLED' if fleet.api_enabled(project_id, name.rsplit('/', 1)[-1].split('.')[0])
+                 else 'DISABLED'}
+                for name in query.get('names', [])
+            ]
+            return self._json('serviceusage.services.batchGet', {'services': services}, fields=fields)
+
+        if method == 'GET' and re.search(r'/v1/services$', path):
+            project_id = query.get('parent', ['projects/unknown'])[0].split('/')[-1]
+            items, token = self._page(fleet.items(project_id, 'services'), query, 'pageSize')
+            return self._json('servicenetworking.services.list',
+                              dict({'services': items}, **({'nextPageToken': token} if token else {})), fields=fields)
+
+        if method == 'GET' and re.search(r'/v3/projects:search$', path):
+            projects = [
+                {
+                    'name': f"projects/{100000 + index}",
+                    'projectId': project_id,
+                    'displayName': project_id,
+                    'state': 'ACTIVE',
+                    'labels': {'env': 'bench'},
+                    'etag': f"W/\"{index}\"",
+                }
+                for index, project_id in enumerate(fleet.project_ids())
+            ]
+            items, token = self._page(projects, query, 'pageSize')
+            return self._json('resourcemanager.projects.search',
+                              dict({'projects': items}, **({'nextPageToken': token} if token else {})), fields=fields)
+
+        match = re.search(r'/v1/(.+):searchAllResources$', path)
+        if method == 'GET' and match:
+            return self._search_assets(match.group(1), query)
+
+        if method == 'POST' and re.search(r'/v2/entries:write$', path):
+            return self._json('logging.entries.write', {})
+
+        match = re.search(r'/upload/storage/v1/b/([^/]+)/o$', path)
+        if match:
+            return self._storage_upload(method, match.group(1), query, body, headers, base_url)
+
+        return self._json('unknown', {'error': {'code': 404, 'message': f"No fake for {method} {path}"}}, status=404)
+
+    def _search_assets(self, scope, query):
+        """Answers searchAllResources from the recording if there is one, otherwise from the fleet."""
+        asset_types = set(query.get('assetTypes', []))
+        read_mask = query.get('readMask', [''])[0].split(',')
+        with_resource = 'versionedResources' in read_mask or '*' in read_mask
+        project_scope = scope.split('/', 1)[1] if scope.startswith('projects/') else None
+
+        if self.asset_recording is not None:
+            results = [
+                result if with_resource else {key: value for key, value in result.items() if key != 'versionedResources'}
+                for result in self.asset_recording
+                if (not asset_types or result.get('assetType') in asset_types)
+                and (project_scope is None or f"/projects/{project_scope}/" in result.get('name', ''))
+            ]
+            results, token = self._page(results, query, 'pageSize')
+        else:
+            # Organizations and folders hold the whole fleet
+            project_ids = [project_scope] if project_scope else self.fleet.project_ids()
+            offset = int(query.get('pageToken', ['0'])[0] or 0)
+            page_size = min(int(query.get('pageSize', [self.max_page_size])[0]), self.max_page_size)
+            results, more = self.fleet.assets(project_ids, asset_types, offset, page_size, with_resource)
+            token = str(offset + page_size) if more else None
+        return self._json('cloudasset.searchAllResources',
+                          dict({'results': results}, **({'nextPageToken': token} if token else {})))
+
+    def _storage_upload(self, method, bucket, query, body, headers, base_url):
+        """Accepts multipart uploads and chunked resumable uploads, keeping only their sizes."""
+        upload_type = query.get('uploadType', ['multipart'])[0]
+        if method == 'POST' and upload_type == 'resumable':
+            upload_id = uuid.uuid4().hex
+            name = json.loads(body or b'{}').get('name') or query.get('name', ['object'])[0]
+            with self._lock:
+                self._uploads[upload_id] = {'name': name, 'size': 0}
+            location = f"{base_url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}"
+            return self._json('storage.objects.insert.resumable', {}, headers={'Location': location})
+
+        if method == 'PUT' and 'upload_id' in query:
+            with self._lock:
+                upload = self._uploads[query['upload_id'][0]]
+                upload['size'] += len(body)
+            content_range = headers.get('Content-Range', '')
+            total = content_range.rsplit('/', 1)[-1] if '/' in content_range else '*'
+            if total == '*' or upload['size'] < int(total):
+                self._count('storage.objects.chunk')
+                return 308, {'Range': f"bytes=0-{upload['size'] - 1}"}, b''
+            return self._json('storage.objects.insert', {'kind': 'storage#object', 'bucket': bucket,
+                                                         'name': upload['name'], 'size': str(upload['size'])})
+
+        name_match = re.search(rb'"name":\s*"([^"]+)"', body or b'')
+        name = name_match.group(1).decode() if name_match else query.get('name', ['object'])[0]
+        return self._json('storage.objects.insert', {'kind': 'storage#object', 'bucket': bucket,
+                                                     'name': name, 'size': str(len(body or b''))})
+
+    def batch(self, body, content_type, base_url):
+        """Answers a multipart/mixed batch request by routing every part as if it had been sent alone."""
+        boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+        response_boundary = f"batch_{uuid.uuid4().hex}"
+        parts = []
+        for raw_part in body.split(b'--' + boundary):
+            raw_part = raw_part.strip(b'\r\n')
+            if not raw_part or raw_part == b'--':
+                continue
+            outer_headers, _, http_request = raw_part.replace(b'\r\n', b'\n').partition(b'\n\n')
+            content_id = re.search(rb'Content-ID:\s*<([^>]+)>', outer_headers, re.IGNORECASE)
+            request_line, _, rest = http_request.partition(b'\n')
+            method, uri, _ = request_line.decode().split(' ', 2)
+            _, _, request_body = rest.partition(b'\n\n')
+            parsed = urlparse(uri)
+            status, headers, response_body = self.route(method, parsed.path, parse_qs(parsed.query),
+                                                        request_body, {}, base_url)
+            header_lines = ''.join(f"{key}: {value}\r\n" for key, value in headers.items())
+            parts.append(
+                f"--{response_boundary}\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id.group(1).decode() if content_id else len(parts)}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n{header_lines}\r\n".encode() + response_body + b"\r\n"
+            )
+        self._count('batch')
+        payload = b''.join(parts) + f"--{response_boundary}--\r\n".encode()
+        return 200, {'Content-Type': f"multipart/mixed; boundary={response_boundary}"}, payload
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                parsed = urlparse(self.path)
+                base_url = f"http://{self.headers.get('Host')}"
+
+                if parsed.path == '/_stats':
+                    if self.command == 'POST':
+                        server.reset_stats()
+                    status, headers, payload = 200, {'Content-Type': 'application/json'}, json.dumps(server.stats()).encode()
+                else:
+                    server.delay()
+                    if parsed.path.startswith('/batch'):
+                        status, headers, payload = server.batch(body, self.headers.get('Content-Type', ''), base_url)
+                    else:
+                        status, headers, payload = server.route(self.command, parsed.path, parse_qs(parsed.query),
+                                                                body, dict(self.headers), base_url)
+
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = _handle
+
+        return Handler
+
+def _descriptor_prefixes(filter_expression):
+    """Returns the metric type prefixes in a 'metric.type = "..."' or 'starts_with("...")' filter."""
+    return re.findall(r'(?:starts_with\(|=)\s*"([^"]+)"', filter_expression or '')
+
+def start_fake_monitoring_server(fake, host='127.0.0.1', port=0):
+    """Serves the Cloud Monitoring MetricService over plaintext gRPC and returns (grpc_server, address).
+
+    The Monitoring client library has no REST transport, so it cannot use the HTTP stand-in.
+    """
+    import grpc
+    from concurrent.futures import ThreadPoolExecutor
+    from google.api import metric_pb2
+    from google.cloud import monitoring_v3
+    from google.protobuf import empty_pb2
+
+    def unary(operation, handle, request_type, response_serializer):
+        def call(request, context):
+            fake.delay()
+            error = fake._inject_error()
+            if error is not None:
+                code = grpc.StatusCode.RESOURCE_EXHAUSTED if error[0] == 429 else grpc.StatusCode.UNAVAILABLE
+                context.abort(code, 'injected error')
+            response = handle(request)
+            fake._count(operation, len(response_serializer(response)))
+            return response
+        return grpc.unary_unary_rpc_method_handler(call, request_deserializer=request_type.deserialize,
+                                                   response_serializer=response_serializer)
+
+    def create_time_series(request):
+        with fake._lock:
+            fake._stats['time_series'] += len(request.time_series)
+        return empty_pb2.Empty()
+
+    def list_metric_descriptors(request):
+        prefixes = _descriptor_prefixes(request.filter)
+        with fake._lock:
+            descriptors = [d for d in fake._descriptors.values()
+                           if not prefixes or any(d.type.startswith(prefix) for prefix in prefixes)]
+        return monitoring_v3.ListMetricDescriptorsResponse(metric_descriptors=descriptors)
+
+    def create_metric_descriptor(request):
+        descriptor = metric_pb2.MetricDescriptor()
+        descriptor.CopyFrom(request.metric_descriptor)
+        descriptor.name = f"{request.name}/metricDescriptors/{descriptor.type}"
+        with fake._lock:
+            fake._descriptors[descriptor.name] = descriptor
+        return descriptor
+
+    def delete_metric_descriptor(request):
+        with fake._lock:
+            fake._descriptors.pop(request.name, None)
+        return empty_pb2.Empty()
+
+    empty = empty_pb2.Empty.SerializeToString
+    handler = grpc.method_handlers_generic_handler('google.monitoring.v3.MetricService', {
+        'CreateTimeSeries': unary('monitoring.timeSeries.create', create_time_series,
+                                  monitoring_v3.CreateTimeSeriesRequest, empty),
+        'ListMetricDescriptors': unary('monitoring.metricDescriptors.list', list_metric_descriptors,
+                                       monitoring_v3.ListMetricDescriptorsRequest,
+                                       monitoring_v3.ListMetricDescriptorsResponse.serialize),
+        'CreateMetricDescriptor': unary('monitoring.metricDescriptors.create', create_metric_descriptor,
+                                        monitoring_v3.CreateMetricDescriptorRequest,
+                                        metric_pb2.MetricDescriptor.SerializeToString),
+        'DeleteMetricDescriptor': unary('monitoring.metricDescriptors.delete', delete_metric_descriptor,
+                                        monitoring_v3.DeleteMetricDescriptorRequest, empty),
+    })
+    grpc_server = grpc.server(ThreadPoolExecutor(max_workers=32))
+    grpc_server.add_generic_rpc_handlers((handler,))
+    bound_port = grpc_server.add_insecure_port(f"{host}:{port}")
+    grpc_server.start()
+    return grpc_server, f"{host}:{bound_port}"
+
+def start_fake_server(fake, host='127.0.0.1', port=0):
+    """Starts the stand-in server on a background thread and returns (http_server, base_url)."""
+    http_server = ThreadingHTTPServer((host, port), fake.handler_class())
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server, f"http://{host}:{http_server.server_address[1]}"
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="Serves a fake fleet of GCP projects for offline benchmarks.")
+    parser.add_argument('--port', type=int, default=8085)
+    parser.add_argument('--grpc-port', type=int, default=8086, help="Port of the gRPC Cloud Monitoring stand-in")
+    parser.add_argument('--projects', type=int, default=100, help="Number of projects in the fleet (up to 10000+)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds added to every response")
+    parser.add_argument('--latency-jitter', type=float, default=0.02, help="Extra random latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with 429/503")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--disabled-api-fraction', type=float, default=0.0,
+                        help="Share of projects with the Cloud DNS API disabled (their DNS calls get a 403)")
+    parser.add_argument('--asset-recording', metavar='PATH',
+                        help="Serve these recorded searchAllResources results (JSON Lines, e.g. from asset_inventory.py)")
+    parser.add_argument('--page-size', type=int, default=default_max_page_size,
+                        help="Largest page any list call returns, whatever page size is asked for")
+    args = parser.parse_args()
+
+    asset_recording = None
+    if args.asset_recording:
+        with open(args.asset_recording) as f:
+            asset_recording = [json.loads(line) for line in f if line.strip()]
+
+    fake = FakeGcpServer(FakeFleet(args.projects, seed=args.seed, disabled_api_fraction=args.disabled_api_fraction), latency=args.latency,
+                         latency_jitter=args.latency_jitter, error_rate=args.error_rate, seed=args.seed,
+                         asset_recording=asset_recording, max_page_size=args.page_size)
+    http_server, url = start_fake_server(fake, port=args.port)
+    grpc_server, grpc_address = start_fake_monitoring_server(fake, port=args.grpc_port)
+    logging.info(f"Fake GCP APIs for {args.projects} projects on {url} and {grpc_address} "
+                 f"(set GCP_API_ENDPOINT={url} GCP_GRPC_ENDPOINT={grpc_address})")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        http_server.shutdown()
+        grpc_server.stop(None)
@@ -0,0 +1,198 @@
+import json
+import logging
+import os
+import threading
+import urllib.request
+
+from run_metrics import get_metrics
+
+# The Google SDK modules below are imported inside the functions that need them: each
+# google-cloud library takes a few hundred milliseconds to import, and most runs only use some
+
+# Scope requested once for every client, so no client has to re-scope (and re-refresh) its own copy
+scopes = ['https://www.googleapis.com/auth/cloud-platform']
+
+# Directory holding cached discovery documents named "<api>.<version>.json"
+discovery_cache_dir = os.environ.get(
+    'DISCOVERY_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'discovery')
+)
+
+# Base URL of a local stand-in server (e.g. fake_gcp_server.py); when set, every client talks to it
+# with anonymous credentials instead of calling Google APIs
+api_endpoint_override = os.environ.get('GCP_API_ENDPOINT')
+
+# host:port of a plaintext gRPC stand-in for the clients that only speak gRPC (Cloud Monitoring)
+grpc_endpoint_override = os.environ.get('GCP_GRPC_ENDPOINT')
+
+# APIs used by the count scripts, pre-fetched by "python gcp_clients.py"
+known_apis = [
+    ('compute', 'v1'),
+    ('dns', 'v1'),
+    ('cloudasset', 'v1'),
+    ('serviceusage', 'v1'),
+]
+
+_lock = threading.RLock()
+_thread_local = threading.local()
+_credentials = None
+_default_project_id = None
+_discovery_documents = {}
+_shared_clients = {}
+
+def get_credentials():
+    """Returns the process-wide default credentials, refreshing the access token in one place when needed."""
+    global _credentials, _default_project_id
+    from google.auth import default
+    from google.auth.credentials import AnonymousCredentials
+    from google.auth.transport.requests import Request
+
+    with _lock:
+        if _credentials is None and api_endpoint_override:
+            _credentials = AnonymousCredentials()
+            _default_project_id = os.environ.get('GOOGLE_CLOUD_PROJECT', 'fake-project')
+        if _credentials is None:
+            # Resolve Application Default Credentials once per process
+            _credentials, _default_project_id = default(scopes=scopes)
+        if not _credentials.valid:
+            _credentials.refresh(Request())
+        return _credentials
+
+def get_default_project_id():
+    """Returns the project ID that came with the default credentials."""
+    get_credentials()
+    return _default_project_id
+
+def _fetch_discovery_document(api, version):
+    """Fetches a discovery document from the bundled copies or, failing that, from the network."""
+    try:
+        # google-api-python-client 2.x ships discovery documents for every public API
+        from googleapiclient.discovery_cache import get_static_doc
+        content = get_static_doc(api, version)
+        if content:
+            return content
+    except ImportError:
+        pass
+
+    url = f"https://www.googleapis.com/discovery/v1/apis/{api}/{version}/rest"
+    logging.info(f"Fetching discovery document {url}")
+    with urllib.request.urlopen(url) as response:
+        return response.read().decode('utf-8')
+
+def get_discovery_document(api, version):
+    """Returns the parsed discovery document for an API, loading it at most once per process."""
+    key = (api, version)
+    with _lock:
+        if key in _discovery_documents:
+            return _discovery_documents[key]
+
+        # Prefer the on-disk cache so no network round trip is needed
+        path = os.path.join(discovery_cache_dir, f"{api}.{version}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                content = f.read()
+        else:
+            content = _fetch_discovery_document(api, version)
+            try:
+                os.makedirs(discovery_cache_dir, exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(content)
+            except OSError as e:
+                logging.warning(f"Could not cache discovery document for {api} {version}: {e}")
+
+        document = json.loads(content)
+        if api_endpoint_override:
+            # Requests and batch requests are built from rootUrl, so point it at the stand-in server
+            document['rootUrl'] = api_endpoint_override.rstrip('/') + '/'
+            document['mtlsRootUrl'] = document['rootUrl']
+        _discovery_documents[key] = document
+        return document
+
+def _measured_http(api):
+    """Returns an authorized HTTP connection that counts the response bytes of one API."""
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
+
+    http = build_http()
+    send = http.request
+
+    def request(*args, **kwargs):
+        response, content = send(*args, **kwargs)
+        get_metrics().inc('response_bytes', len(content or b''), service=api)
+        return response, content
+
+    http.request = request
+    return AuthorizedHttp(get_credentials(), http=http)
+
+def get_service(api, version):
+    """Returns the discovery-based client for (api, version), built once per worker thread."""
+    # httplib2 connections are not thread-safe, so each thread keeps its own set of clients
+    services = getattr(_thread_local, 'services', None)
+    if services is None:
+        services = _thread_local.services = {}
+
+    key = (api, version)
+    if key not in services:
+        from googleapiclient.discovery import build_from_document
+        services[key] = build_from_document(get_discovery_document(api, version), http=_measured_http(api))
+    return services[key]
+
+def _client_options():
+    """Returns the keyword arguments that point a Cloud client library at the stand-in server, if any."""
+    if not api_endpoint_override:
+        return {}
+    return {'client_options': {'api_endpoint': api_endpoint_override}}
+
+def _get_shared_client(name, factory):
+    """Returns a thread-safe client shared by the whole process, creating it on first use."""
+    with _lock:
+        if name not in _shared_clients:
+            _shared_clients[name] = factory()
+        return _shared_clients[name]
+
+def get_metric_client():
+    """Returns the shared Cloud Monitoring client."""
+    def create():
+        from google.cloud import monitoring_v3
+        if grpc_endpoint_override:
+            import grpc
+            from google.cloud.monitoring_v3.services.metric_service.transports import MetricServiceGrpcTransport
+
+            # The Monitoring library has no REST transport, so its stand-in is reached over plaintext gRPC
+            channel = grpc.insecure_channel(grpc_endpoint_override)
+            return monitoring_v3.MetricServiceClient(transport=MetricServiceGrpcTransport(channel=channel))
+        return monitoring_v3.MetricServiceClient(credentials=get_credentials())
+    return _get_shared_client('monitoring', create)
+
+def get_storage_client():
+    """Returns the shared Cloud Storage client."""
+    def create():
+        from google.cloud import storage
+        return storage.Client(credentials=get_credentials(), project=get_default_project_id(), **_client_options())
+    return _get_shared_client('storage', create)
+
+def get_logging_client():
+    """Returns the shared Cloud Logging client."""
+    def create():
+        from google.cloud import logging as cloud_logging
+        # The stand-in server speaks REST, not gRPC
+        transport = {'_use_grpc': False} if api_endpoint_override else {}
+        return cloud_logging.Client(credentials=get_credentials(), project=get_default_project_id(),
+                                    **transport, **_client_options())
+    return _get_shared_client('logging', create)
+
+def get_projects_client():
+    """Returns the shared Resource Manager projects client."""
+    def create():
+        from google.cloud import resourcemanager_v3
+        transport = {'transport': 'rest'} if api_endpoint_override else {}
+        return resourcemanager_v3.ProjectsClient(credentials=get_credentials(), **transport, **_client_options())
+    return _get_shared_client('projects', create)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    # Pre-populate the on-disk discovery cache so later runs never fetch a discovery document
+    for api, version in known_apis:
+        get_discovery_document(api, version)
+        logging.info(f"Cached discovery document for {api} {version} in {discovery_cache_dir}")
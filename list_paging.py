@@ -0,0 +1,48 @@
+import hashlib
+from rate_limit import get_governor
+from run_metrics import get_metrics
+
+# Page size parameter and the largest page each API's list methods will return
+page_sizes = {
+    'compute': ('maxResults', 500),
+    'dns': ('maxResults', 1000),
+    'cloudasset': ('pageSize', 500),
+}
+
+class IdSetFingerprint:
+    """Order-independent hash of a set of item IDs, built one ID at a time in constant memory."""
+
+    def __init__(self):
+        self._sum = 0
+
+    def add(self, item_id):
+        digest = hashlib.sha256(str(item_id).encode('utf-8')).digest()
+        self._sum = (self._sum + int.from_bytes(digest[:16], 'big')) % (1 << 128)
+
+    def hexdigest(self):
+        return f"{self._sum:032x}"
+
+def list_request(resource, api='compute', method='list', fields=None, **params):
+    """Builds the first-page request of a discovery list method at the API's largest page size."""
+    page_size_param, page_size = page_sizes[api]
+    params[page_size_param] = page_size
+    if fields:
+        # Partial response: only the requested fields travel over the wire
+        params['fields'] = fields
+    return getattr(resource, method)(**params)
+
+def iter_pages(resource, api='compute', method='list', fields=None, **params):
+    """Yields one response page at a time from a discovery list method, following nextPageToken."""
+    request = list_request(resource, api=api, method=method, fields=fields, **params)
+    while request is not None:
+        # Every page goes through the per-API governor, which throttles and retries quota errors
+        response = get_governor().execute(api, request.execute)
+        get_metrics().inc('list_pages', service=api)
+        yield response
+
+        # Ask for the next page by token rather than with <method>_next, which cannot rebuild
+        # URLs with repeated query parameters such as searchAllResources' assetTypes
+        next_page_token = response.get('nextPageToken')
+        request = None
+        if next_page_token:
+            request = list_request(resource, api=api, method=method, fields=fields, pageToken=next_page_token, **params)
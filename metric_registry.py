@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from resource_registry import resource_definitions
+
+metric_prefix = "custom.googleapis.com/"
+
+def breakdown_metric_name(resource, field):
+    """Returns the name of the metric holding a resource's counts per value of a breakdown field."""
+    return f"{resource}_count_by_{field}"
+
+# Region label of the project total that regional resources publish next to their per-region counts
+total_region = 'all'
+
+# Every custom metric written by the count scripts: (name, display name, description, labels),
+# one per registered resource; regional resources carry a region label
+metric_definitions = [
+    (f"{definition['resource']}_count", f"{definition['label']} Count", f"{definition['label']} Count in the project",
+     ['project_id', 'region'] if definition['scope'] == 'regional' else ['project_id'])
+    for definition in resource_definitions
+]
+
+# Plus one per breakdown of a resource, e.g. firewall_count_by_network with a network label
+metric_definitions += [
+    (breakdown_metric_name(definition['resource'], field), f"{definition['label']} Count by {field}",
+     f"{definition['label']} Count in the project per {field}", ['project_id', field])
+    for definition in resource_definitions
+    for field in definition.get('breakdowns') or []
+]
+
+label_descriptions = {
+    'project_id': "ID of the GCP Project",
+    'region': f"Region the resources are in, or '{total_region}' for the project total",
+    'network': "VPC network the resources belong to",
+    'direction': "Direction of the firewall rules (INGRESS or EGRESS)",
+    'status': "Status of the VPN tunnels",
+    'visibility': "Visibility of the DNS zones (public or private)",
+    'state': "State of the VPC peerings (ACTIVE or INACTIVE)",
+}
+
+# Where reconciled descriptors are remembered, and for how long before checking again
+descriptor_cache_path = os.environ.get(
+    'METRIC_DESCRIPTOR_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'metric_descriptors.json')
+)
+descriptor_cache_ttl = 24 * 60 * 60
+
+def metric_type(name):
+    """Returns the full metric type for a registered metric name, e.g. vpc_count."""
+    return f"{metric_prefix}{name}"
+
+def build_descriptor(name):
+    """Builds the MetricDescriptor declared for a registered metric name."""
+    from google.api import label_pb2 as ga_label
+    from google.api import metric_pb2 as ga_metric
+
+    for metric_name, display_name, description, labels in metric_definitions:
+        if metric_name == name:
+            return ga_metric.MetricDescriptor(
+                type=metric_type(name),
+                metric_kind=ga_metric.MetricDescriptor.MetricKind.GAUGE,
+                value_type=ga_metric.MetricDescriptor.ValueType.INT64,
+                description=description,
+                display_name=display_name,
+                labels=[
+                    ga_label.LabelDescriptor(
+                        key=key,
+                        value_type=ga_label.LabelDescriptor.ValueType.STRING,
+                        description=label_descriptions[key]
+                    )
+                    for key in labels
+                ]
+            )
+    raise KeyError(f"Unknown metric: {name}")
+
+def _schema(descriptor):
+    """Returns the parts of a descriptor that matter for drift: kind, value type and label keys."""
+    return {
+        'metric_kind': int(descriptor.metric_kind),
+        'value_type': int(descriptor.value_type),
+        'labels': sorted(label.key for label in descriptor.labels),
+    }
+
+def _schema_hash(descriptor):
+    return hashlib.sha256(json.dumps(_schema(descriptor), sort_keys=True).encode()).hexdigest()
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_cache(cache_path, cache):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write metric descriptor cache {cache_path}: {e}")
+
+def forget_metric_descriptors(project_id, metric_types, cache_path=descriptor_cache_path):
+    """Drops deleted descriptors from the local cache, so the next reconcile recreates them."""
+    names = {metric_type[len(metric_prefix):] for metric_type in metric_types if metric_type.startswith(metric_prefix)}
+    cache = _load_cache(cache_path)
+    project_cache = cache.get(project_id, {})
+    if not names & set(project_cache):
+        return
+    for name in names:
+        project_cache.pop(name, None)
+    _save_cache(cache_path, cache)
+
+def ensure_metric_descriptors(client, project_id, names=None, cache_path=descriptor_cache_path,
+                              ttl=descriptor_cache_ttl):
+    """Creates or updates only the registered descriptors that are missing or have drifted.
+
+    Returns {name: 'created' | 'updated' | 'conflict'} for the descriptors that needed attention.
+    A fresh local cache entry with a matching schema skips the API entirely.
+    """
+    names = names or [definition[0] for definition in metric_definitions]
+    wanted = {name: build_descriptor(name) for name in names}
+
+    # Skip the API when every requested descriptor was reconciled recently with the same schema
+    cache = _load_cache(cache_path)
+    project_cache = cache.setdefault(project_id, {})
+    now = time.time()
+    if all(project_cache.get(name, {}).get('schema') == _schema_hash(descriptor)
+           and now - project_cache[name].get('checked', 0) < ttl
+           for name, descriptor in wanted.items()):
+        logging.info(f"Metric descriptors for {project_id} are up to date (cached)")
+        return {}
+
+    # One list call returns every custom descriptor in the project
+    project_name = f"projects/{project_id}"
+    existing = {
+        descriptor.type: descriptor
+        for descriptor in client.list_metric_descriptors(request={
+            'name': project_name,
+            'filter': f'metric.type = starts_with("{metric_prefix}")',
+        })
+    }
+
+    actions = {}
+    for name, descriptor in wanted.items():
+        current = existing.get(descriptor.type)
+        if current is not None:
+            current_schema, wanted_schema = _schema(current), _schema(descriptor)
+            if current_schema == wanted_schema:
+                project_cache[name] = {'schema': _schema_hash(descriptor), 'checked': now}
+                continue
+
+            # Labels can be added in place; a changed kind, value type or removed label cannot
+            if (current_schema['metric_kind'] != wanted_schema['metric_kind']
+                    or current_schema['value_type'] != wanted_schema['value_type']
+                    or not set(current_schema['labels']) <= set(wanted_schema['labels'])):
+                logging.error(f"Metric descriptor {descriptor.type} has drifted ({current_schema} != {wanted_schema}) "
+                              f"and must be deleted and recreated")
+                actions[name] = 'conflict'
+                project_cache.pop(name, None)
+                continue
+            logging.warning(f"Metric descriptor {descriptor.type} is missing labels "
+                            f"{sorted(set(wanted_schema['labels']) - set(current_schema['labels']))}, updating it")
+            actions[name] = 'updated'
+        else:
+            actions[name] = 'created'
+
+        client.create_metric_descriptor(name=project_name, metric_descriptor=descriptor)
+        logging.info(f"{actions[name].capitalize()} custom metric: {descriptor.type}")
+        project_cache[name] = {'schema': _schema_hash(descriptor), 'checked': now}
+
+    _save_cache(cache_path, cache)
+    return actions
@@ -0,0 +1,125 @@
+import logging
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import get_governor
+
+# Cloud Monitoring accepts at most 200 time series per create_time_series request
+max_series_per_request = 200
+
+# Times the rejected series of a partly written request are sent again
+partial_failure_retries = 2
+
+# google.rpc.Code values of rejected series that may be accepted on another try
+# (DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE)
+retryable_status_codes = {4, 8, 10, 13, 14}
+
+def _rejected_series(error, series_count):
+    """Returns (written, rejected indices, retryable) for a create_time_series error that wrote part of its
+    request, or None if it carries no CreateTimeSeriesSummary (nothing was written).
+
+    The summary gives the number written and the status of the rejections; the message names the
+    rejected series, e.g. "...: timeSeries[0-16,25]".
+    """
+    from google.cloud import monitoring_v3
+
+    summary = monitoring_v3.CreateTimeSeriesSummary.pb()()
+    for detail in getattr(error, 'details', None) or []:
+        # Details the client library does not know stay packed in a protobuf Any
+        if hasattr(detail, 'Is') and detail.Is(summary.DESCRIPTOR):
+            detail.Unpack(summary)
+            break
+    else:
+        return None
+
+    rejected = set()
+    for ranges in re.findall(r'timeSeries\[([\d,\- ]+)\]', getattr(error, 'message', None) or str(error)):
+        for part in ranges.split(','):
+            first, _, last = part.strip().partition('-')
+            rejected.update(range(int(first), int(last or first) + 1))
+    retryable = any(status.status.code in retryable_status_codes for status in summary.errors)
+    # Every series carries one point, so points written are series written
+    return summary.success_point_count, sorted(index for index in rejected if index < series_count), retryable
+
+class MetricWriter:
+    """Collects gauge points for many metrics and projects and writes them with as few RPCs as possible."""
+
+    def __init__(self, client, host_project_id, max_workers=8):
+        self.client = client
+        self.project_name = f"projects/{host_project_id}"
+        self.max_workers = max_workers
+        self._series = []
+        self._lock = threading.Lock()
+
+        # Every point written by this writer shares one timestamp
+        from google.protobuf.timestamp_pb2 import Timestamp
+        self._now = Timestamp()
+        self._now.GetCurrentTime()
+
+    def add(self, metric_type, value, project_id, **labels):
+        """Queues one INT64 gauge point labelled with the project it was counted in."""
+        # Imported on first use so modules that only might publish metrics stay quick to import
+        from google.cloud import monitoring_v3
+
+        series = monitoring_v3.TimeSeries()
+        series.metric.type = metric_type
+        series.metric.labels["project_id"] = project_id
+        for key, label_value in labels.items():
+            series.metric.labels[key] = label_value
+        series.resource.type = "global"
+
+        # Set the same start and end time for gauge metric
+        point = monitoring_v3.Point()
+        point.value.int64_value = value
+        point.interval = monitoring_v3.TimeInterval(end_time=self._now, start_time=self._now)
+        series.points.append(point)
+
+        with self._lock:
+            self._series.append(series)
+
+    def _write_chunk(self, chunk):
+        """Writes one request's worth of series and returns how many were written.
+
+        The governor retries quota and transient errors of the whole request. When only some series are
+        rejected, those are sent again if their error may go away, and reported otherwise.
+        """
+        from google.api_core import exceptions as api_exceptions
+
+        written = 0
+        for attempt in range(partial_failure_retries + 1):
+            def write(series=chunk):
+                self.client.create_time_series(name=self.project_name, time_series=series)
+
+            try:
+                get_governor().execute('monitoring', write)
+                return written + len(chunk)
+            except api_exceptions.GoogleAPICallError as e:
+                partial = _rejected_series(e, len(chunk))
+                if partial is None:
+                    logging.error(f"Error writing {len(chunk)} time series: {e}")
+                    return written
+                # Series that were accepted stay written; only the rejected ones can be sent again
+                accepted, rejected, retryable = partial
+                accepted = min(accepted, len(chunk))
+                written += accepted
+                if not (retryable and rejected) or attempt == partial_failure_retries:
+                    logging.error(f"{len(chunk) - accepted} of {len(chunk)} time series were rejected: {e.message}")
+                    return written
+                logging.warning(f"Sending {len(rejected)} of {len(chunk)} time series again after a partial failure: "
+                                f"{e.message}")
+                chunk = [chunk[index] for index in rejected]
+
+    def flush(self):
+        """Writes every queued point in concurrent chunks of the largest allowed request and returns how many were written."""
+        with self._lock:
+            series, self._series = self._series, []
+        if not series:
+            return 0
+
+        chunks = [series[i:i + max_series_per_request] for i in range(0, len(series), max_series_per_request)]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(chunks)))) as executor:
+            written = sum(executor.map(self._write_chunk, chunks))
+
+        logging.info(f"Wrote {written} of {len(series)} time series in {len(chunks)} requests")
+        return written
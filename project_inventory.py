@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import time
+
+from gcp_clients import get_projects_client
+
+# Where discovered projects are remembered, and for how long before searching again
+inventory_cache_path = os.environ.get(
+    'PROJECT_INVENTORY_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'project_inventory.json')
+)
+inventory_cache_ttl = 6 * 60 * 60
+
+def build_project_query(labels=None, name=None, parent=None, state='ACTIVE'):
+    """Builds a search_projects query so Resource Manager does the filtering, e.g. 'state:ACTIVE labels.env:tst'."""
+    terms = []
+    if state:
+        terms.append(f"state:{state}")
+    for key, value in (labels or {}).items():
+        terms.append(f"labels.{key}:{value}")
+    if name:
+        terms.append(f"id:{name}")
+    if parent:
+        terms.append(f"parent:{parent}")
+    return " ".join(terms)
+
+def _load_inventory(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_inventory(cache_path, inventory):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(inventory, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not write project inventory {cache_path}: {e}")
+
+def search_active_projects(query):
+    """Streams the ACTIVE projects matching a search_projects query, one project at a time."""
+    for project in get_projects_client().search_projects(query=query):
+        # The query normally filters on state already; this also covers queries that do not
+        if project.state.name != 'ACTIVE':
+            continue
+        yield {
+            'project_id': project.project_id,
+            'display_name': project.display_name,
+            'labels': dict(project.labels),
+            'etag': project.etag,
+            'update_time': project.update_time.isoformat() if project.update_time else None,
+        }
+
+def discover_projects(query='state:ACTIVE', contains=None, cache_path=inventory_cache_path,
+                      ttl=inventory_cache_ttl, force_refresh=False):
+    """Returns the IDs of the ACTIVE projects matching a query, from the local inventory while it is fresh.
+
+    `contains` keeps only project IDs containing the given text (Resource Manager only matches prefixes).
+    """
+    inventory = _load_inventory(cache_path)
+    entry = inventory.get(query)
+
+    if entry and not force_refresh and time.time() - entry['refreshed'] < ttl:
+        projects = entry['projects']
+        logging.info(f"Using {len(projects)} projects from the inventory cache for '{query}'")
+    else:
+        # Re-stream the server-filtered search and diff it against the previous inventory
+        previous = entry['projects'] if entry else {}
+        projects = {project['project_id']: project for project in search_active_projects(query)}
+
+        added = [project_id for project_id in projects if project_id not in previous]
+        removed = [project_id for project_id in previous if project_id not in projects]
+        changed = [project_id for project_id, project in projects.items()
+                   if project_id in previous and previous[project_id].get('etag') != project['etag']]
+        logging.info(f"Project inventory for '{query}': {len(projects)} projects "
+                     f"({len(added)} added, {len(changed)} changed, {len(removed)} removed)")
+
+        inventory[query] = {'refreshed': time.time(), 'projects': projects}
+        _save_inventory(cache_path, inventory)
+
+    project_ids = sorted(projects)
+    if contains:
+        project_ids = [project_id for project_id in project_ids if contains in project_id]
+    return project_ids
@@ -0,0 +1,219 @@
+import logging
+import random
+import threading
+import time
+
+from run_metrics import get_metrics
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts of up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` are available, then takes them."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Default per-API limits: sustained calls per second, burst size and the most concurrent calls allowed
+default_service_limits = {
+    'compute': {'rate': 20, 'burst': 40, 'concurrency': 32},
+    'dns': {'rate': 10, 'burst': 20, 'concurrency': 16},
+    'servicenetworking': {'rate': 5, 'burst': 10, 'concurrency': 8},
+    'monitoring': {'rate': 20, 'burst': 40, 'concurrency': 16},
+    'storage': {'rate': 10, 'burst': 20, 'concurrency': 8},
+    'logging': {'rate': 10, 'burst': 20, 'concurrency': 4},
+    'cloudresourcemanager': {'rate': 5, 'burst': 10, 'concurrency': 4},
+    'cloudasset': {'rate': 5, 'burst': 10, 'concurrency': 4},
+    'serviceusage': {'rate': 5, 'burst': 10, 'concurrency': 8},
+}
+
+# HTTP statuses that mean "try again later" rather than "this will never work"
+transient_statuses = {500, 502, 503, 504}
+quota_reasons = (b'rateLimitExceeded', b'userRateLimitExceeded', b'quotaExceeded', b'RESOURCE_EXHAUSTED')
+
+def error_status(error):
+    """Returns the HTTP status of a googleapiclient HttpError or google.api_core exception, if any."""
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        return int(resp.status)
+    code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+def is_quota_error(error):
+    """Returns True for 429s and 403s whose reason is a rate or quota limit."""
+    status = error_status(error)
+    if status == 429:
+        return True
+    content = getattr(error, 'content', b'') or b''
+    return status == 403 and any(reason in content for reason in quota_reasons)
+
+def is_transient_error(error):
+    return error_status(error) in transient_statuses
+
+def retry_after_seconds(error):
+    """Returns the server's Retry-After delay in seconds, if it sent one."""
+    resp = getattr(error, 'resp', None)
+    try:
+        value = resp.get('retry-after') if resp is not None else None
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+class AimdLimiter:
+    """Concurrency limit that grows additively on success and halves on quota errors."""
+
+    def __init__(self, maximum, minimum=1):
+        self.maximum = float(maximum)
+        self.minimum = float(minimum)
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                # Multiplicative decrease
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                # Additive increase: about +1 once a full window of calls has succeeded
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+class RequestGovernor:
+    """Shapes calls per API with a token bucket and an AIMD concurrency limit, retrying quota and transient errors."""
+
+    def __init__(self, limits=None, max_attempts=6, max_backoff=60):
+        self.limits = {service: dict(limit) for service, limit in default_service_limits.items()}
+        for service, limit in (limits or {}).items():
+            self.limits.setdefault(service, {}).update(limit)
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+        self._services = {}
+        self._lock = threading.Lock()
+
+    def configure(self, service, rate=None, burst=None, concurrency=None):
+        """Changes one API's limits; takes effect for calls made from now on."""
+        with self._lock:
+            limit = self.limits.setdefault(service, dict(default_service_limits['compute']))
+            for key, value in (('rate', rate), ('burst', burst), ('concurrency', concurrency)):
+                if value is not None:
+                    limit[key] = value
+            self._services.pop(service, None)
+
+    def share(self, parts):
+        """Scales every API's rate, burst and concurrency down to 1/parts, for one of `parts` processes sharing a quota."""
+        with self._lock:
+            for limit in self.limits.values():
+                for key in ('rate', 'burst', 'concurrency'):
+                    if limit.get(key) is not None:
+                        limit[key] = max(1, limit[key] / parts) if key == 'rate' else max(1, int(limit[key] // parts))
+            self._services.clear()
+
+    def _service(self, service):
+        with self._lock:
+            if service not in self._services:
+                limit = self.limits.get(service, default_service_limits['compute'])
+                self._services[service] = {
+                    'bucket': TokenBucket(limit['rate'], limit.get('burst')),
+                    'limiter': AimdLimiter(limit['concurrency']),
+                    'calls': 0,
+                    'throttled': 0,
+                    'retries': 0,
+                }
+            return self._services[service]
+
+    def _count(self, state, counter):
+        with self._lock:
+            state[counter] += 1
+
+    def execute(self, service, call):
+        """Runs call() under the API's limits, retrying quota and transient errors with jittered backoff."""
+        state = self._service(service)
+        for attempt in range(1, self.max_attempts + 1):
+            state['bucket'].acquire()
+            state['limiter'].acquire()
+            start = time.monotonic()
+            try:
+                result = call()
+            except Exception as e:
+                get_metrics().observe('api_request_duration_seconds', time.monotonic() - start, service=service)
+                get_metrics().inc('api_requests', service=service, outcome='error')
+                throttled = is_quota_error(e)
+                state['limiter'].release(throttled=throttled)
+                if throttled:
+                    self._count(state, 'throttled')
+                    get_metrics().inc('api_throttled', service=service)
+                if not (throttled or is_transient_error(e)) or attempt == self.max_attempts:
+                    raise
+
+                # Honour Retry-After when given, otherwise full-jitter exponential backoff
+                delay = retry_after_seconds(e)
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+                self._count(state, 'retries')
+                get_metrics().inc('api_retries', service=service)
+                logging.warning(f"{service} call failed ({error_status(e)}), retry {attempt} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            get_metrics().observe('api_request_duration_seconds', time.monotonic() - start, service=service)
+            get_metrics().inc('api_requests', service=service, outcome='ok')
+            state['limiter'].release()
+            self._count(state, 'calls')
+            return result
+
+    def snapshot(self):
+        """Returns the current limits and counters per API, for logging or export."""
+        with self._lock:
+            services = dict(self._services)
+        return {
+            service: {
+                'rate': state['bucket'].rate,
+                'concurrency_limit': round(state['limiter'].limit, 2),
+                'in_flight': state['limiter'].in_flight,
+                'calls': state['calls'],
+                'throttled': state['throttled'],
+                'retries': state['retries'],
+            }
+            for service, state in sorted(services.items())
+        }
+
+_default_governor = RequestGovernor()
+
+def get_governor():
+    """Returns the process-wide request governor."""
+    return _default_governor
+
+def parse_rate_limits(values):
+    """Parses ['compute=20:16', 'dns=5'] into {'compute': {'rate': 20.0, 'concurrency': 16}, 'dns': {'rate': 5.0}}."""
+    limits = {}
+    for value in values:
+        service, _, spec = value.partition('=')
+        rate, _, concurrency = spec.partition(':')
+        limits[service] = {'rate': float(rate)}
+        if concurrency:
+            limits[service]['concurrency'] = int(concurrency)
+    return limits
@@ -0,0 +1,356 @@
+import logging
+import re
+import time
+
+from batch_requests import count_in_batches
+from gcp_clients import get_service
+from list_paging import IdSetFingerprint, iter_pages
+from run_metrics import get_metrics
+
+# Every countable resource, described as data. The planner turns a set of these into the fewest
+# list calls per project:
+#   resource   name used in run reports, sweep state and the "<resource>_count" custom metric
+#   label      human-readable name used in log lines and metric descriptors
+#   api, version, collection
+#              discovery client and collection the items are listed from
+#   scope      'regional' resources are listed in every region at once with aggregatedList and
+#              counted per region; 'global' (Compute) and 'project' (other APIs) use list
+#   items_key  response key holding the items of a list call (aggregatedList uses the collection)
+#   match      optional {field: value} the items must have; resources on the same collection
+#              share one listing and are told apart with it
+#   asset_type Cloud Asset Inventory type of the items, for the asset search backend
+#   items_field
+#              optional list field of each item whose entries are counted instead of the items
+#              (e.g. the peerings of each network); IDs, matches and breakdowns then refer to entries
+#   breakdowns optional item fields the project total is also broken down by, in the same pass over
+#              the items (e.g. firewalls per network and direction); URLs are reduced to their last part
+resource_definitions = [
+    {'resource': 'vpn_tunnel', 'label': 'VPN Tunnel', 'api': 'compute', 'version': 'v1',
+     'collection': 'vpnTunnels', 'scope': 'regional', 'items_key': 'vpnTunnels',
+     'asset_type': 'compute.googleapis.com/VpnTunnel', 'breakdowns': ['status']},
+    {'resource': 'vpc', 'label': 'VPC', 'api': 'compute', 'version': 'v1',
+     'collection': 'networks', 'scope': 'global', 'items_key': 'items',
+     'asset_type': 'compute.googleapis.com/Network'},
+    {'resource': 'dns_zone', 'label': 'DNS Zone', 'api': 'dns', 'version': 'v1',
+     'collection': 'managedZones', 'scope': 'project', 'items_key': 'managedZones',
+     'asset_type': 'dns.googleapis.com/ManagedZone', 'breakdowns': ['visibility']},
+    {'resource': 'cloud_router', 'label': 'Cloud Router', 'api': 'compute', 'version': 'v1',
+     'collection': 'routers', 'scope': 'regional', 'items_key': 'routers',
+     'asset_type': 'compute.googleapis.com/Router', 'breakdowns': ['network']},
+    # Peerings are listed on the networks themselves, so they come from the same listing as the VPCs
+    {'resource': 'vpc_peering', 'label': 'VPC Peering', 'api': 'compute', 'version': 'v1',
+     'collection': 'networks', 'scope': 'global', 'items_key': 'items', 'items_field': 'peerings',
+     'asset_type': 'compute.googleapis.com/Network', 'breakdowns': ['state']},
+    {'resource': 'firewall', 'label': 'Firewall', 'api': 'compute', 'version': 'v1',
+     'collection': 'firewalls', 'scope': 'global', 'items_key': 'items',
+     'asset_type': 'compute.googleapis.com/Firewall', 'breakdowns': ['network', 'direction']},
+    # Private Service Access ranges are the global addresses allocated for VPC peering
+    {'resource': 'private_service_access_range', 'label': 'Private Service Access Range', 'api': 'compute',
+     'version': 'v1', 'collection': 'globalAddresses', 'scope': 'global', 'items_key': 'items',
+     'match': {'purpose': 'VPC_PEERING'},
+     'asset_type': 'compute.googleapis.com/GlobalAddress', 'breakdowns': ['network']},
+    {'resource': 'subnetwork', 'label': 'Subnetwork', 'api': 'compute', 'version': 'v1',
+     'collection': 'subnetworks', 'scope': 'regional', 'items_key': 'subnetworks',
+     'asset_type': 'compute.googleapis.com/Subnetwork', 'breakdowns': ['network']},
+    {'resource': 'forwarding_rule', 'label': 'Forwarding Rule', 'api': 'compute', 'version': 'v1',
+     'collection': 'forwardingRules', 'scope': 'regional', 'items_key': 'forwardingRules',
+     'asset_type': 'compute.googleapis.com/ForwardingRule', 'breakdowns': ['network']},
+]
+
+# Every registered resource name, in registry order
+resource_names = [definition['resource'] for definition in resource_definitions]
+
+def get_definition(resource):
+    """Returns the registry entry of a resource name."""
+    for definition in resource_definitions:
+        if definition['resource'] == resource:
+            return definition
+    raise KeyError(f"Unknown resource: {resource}")
+
+def breakdown_value(value):
+    """Returns the label an item field is counted under: the last part of a URL, or 'none' when unset."""
+    if value is None or value == '':
+        return 'none'
+    return str(value).rsplit('/', 1)[-1]
+
+def _server_filter(match):
+    """Turns {field: value} into a Compute list filter, e.g. purpose = "VPC_PEERING"."""
+    terms = [f'{field} = "{value}"' for field, value in sorted(match.items())]
+    return terms[0] if len(terms) == 1 else ' '.join(f"({term})" for term in terms)
+
+def plan_listings(resources=None, id_field='name'):
+    """Compiles resource names into the fewest listings; each listing counts every resource it serves.
+
+    Resources on the same API collection share one listing. A listing that serves a single resource
+    with a match on Compute has the match applied by the server instead, so fewer items come back.
+    """
+    listings = {}
+    for resource in (resources or resource_names):
+        definition = get_definition(resource)
+        key = (definition['api'], definition['version'], definition['collection'], definition['scope'])
+        listing = listings.setdefault(key, {
+            'api': definition['api'],
+            'version': definition['version'],
+            'collection': definition['collection'],
+            'scope': definition['scope'],
+            'method': 'aggregatedList' if definition['scope'] == 'regional' else 'list',
+            'items_key': definition['collection'] if definition['scope'] == 'regional' else definition['items_key'],
+            'id_field': id_field,
+            'params': {},
+            'resources': [],
+        })
+        listing['resources'].append(definition)
+
+    for listing in listings.values():
+        matches = {definition['resource']: dict(definition.get('match') or {}) for definition in listing['resources']}
+        listing['items_fields'] = {definition['resource']: definition['items_field']
+                                   for definition in listing['resources'] if definition.get('items_field')}
+        if len(matches) == 1 and listing['api'] == 'compute' and not listing['items_fields']:
+            (resource, match), = matches.items()
+            if match:
+                listing['params']['filter'] = _server_filter(match)
+                matches[resource] = {}
+        listing['matches'] = matches
+        listing['breakdowns'] = {definition['resource']: list(definition.get('breakdowns') or [])
+                                 for definition in listing['resources']}
+
+        # Partial response: the ID plus whatever the client-side matches and breakdowns look at; for
+        # counted entries (e.g. peerings) the same fields are asked for inside their list field
+        fields, entry_fields = set(), {}
+        for resource, match in matches.items():
+            needed = set(match) | set(listing['breakdowns'][resource])
+            if resource in listing['items_fields']:
+                entry_fields.setdefault(listing['items_fields'][resource], {id_field}).update(needed)
+            else:
+                fields |= needed
+        item_fields = ','.join([id_field] + sorted(fields - {id_field})
+                               + [f"{field}({','.join(sorted(names))})" for field, names in sorted(entry_fields.items())])
+        if listing['method'] == 'aggregatedList':
+            listing['fields'] = f"items/*/{listing['items_key']}({item_fields}),unreachables,nextPageToken"
+        else:
+            listing['fields'] = f"{listing['items_key']}({item_fields}),nextPageToken"
+
+    # Group listings by API so batch mode and client reuse see each API's calls together
+    return sorted(listings.values(), key=lambda listing: (listing['api'], listing['version']))
+
+def plan_calls(projects, resources=None):
+    """Returns the (project, listing) calls needed to count `resources` in every project, grouped by API."""
+    listings = plan_listings(resources)
+    calls = [(project, listing) for listing in listings for project in projects]
+    resource_count = sum(len(listing['resources']) for listing in listings)
+    logging.info(f"Planned {len(calls)} listings for {resource_count} resource types in {len(projects)} projects "
+                 f"({resource_count * len(projects) - len(calls)} saved by sharing listings)")
+    return calls
+
+class ListingCount:
+    """Counts every resource served by one listing, per region for regional ones and per value of each
+    breakdown field, as pages stream past."""
+
+    def __init__(self, listing, project_id):
+        self.listing = listing
+        self.project_id = project_id
+        self.counts = {resource: 0 for resource in listing['matches']}
+        self.regions = {resource: {} for resource in listing['matches']}
+        self.fingerprints = {resource: IdSetFingerprint() for resource in listing['matches']}
+        self.breakdowns = {resource: {field: {} for field in fields}
+                           for resource, fields in listing.get('breakdowns', {}).items()}
+
+    def _add_items(self, items, region=None, id_prefix=''):
+        id_field = self.listing['id_field']
+        for resource, match in self.listing['matches'].items():
+            # (thing counted, its ID): the items themselves, or the entries of one of their list fields
+            items_field = self.listing.get('items_fields', {}).get(resource)
+            if items_field:
+                counted = [(entry, f"{id_prefix}{item.get(id_field)}/{entry.get(id_field)}")
+                           for item in items for entry in item.get(items_field) or []]
+            else:
+                counted = [(item, f"{id_prefix}{item.get(id_field)}") for item in items]
+            matching = [(item, item_id) for item, item_id in counted
+                        if all(item.get(field) == value for field, value in match.items())]
+            if not matching:
+                continue
+            self.counts[resource] += len(matching)
+            if region is not None:
+                self.regions[resource][region] = self.regions[resource].get(region, 0) + len(matching)
+            breakdowns = self.breakdowns.get(resource, {})
+            for item, item_id in matching:
+                self.fingerprints[resource].add(item_id)
+                for field, counts in breakdowns.items():
+                    value = breakdown_value(item.get(field))
+                    counts[value] = counts.get(value, 0) + 1
+
+    def add_page(self, page):
+        """Adds one list or aggregatedList response page."""
+        if self.listing['method'] != 'aggregatedList':
+            self._add_items(page.get(self.listing['items_key'], []))
+            return
+
+        # Items are keyed by scope, e.g. "regions/us-central1": {"vpnTunnels": [...]} or {"warning": {...}}
+        for scope, scoped_list in page.get('items', {}).items():
+            # Names are only unique within a region, so the scope is part of the ID
+            self._add_items(scoped_list.get(self.listing['items_key'], []), region=scope.split('/')[-1],
+                            id_prefix=f"{scope}/")
+        for unreachable in page.get('unreachables', []):
+            logging.warning(f"Could not list {self.listing['collection']} in {unreachable} for {self.project_id}")
+
+    def results(self):
+        """Returns {resource: {'count', 'regions', 'fingerprint', 'breakdowns'}}; regions is None for
+        non-regional resources and breakdowns ({field: {value: count}}) is None for resources without any."""
+        regional = self.listing['scope'] == 'regional'
+        return {
+            resource: {
+                'count': count,
+                'regions': self.regions[resource] if regional else None,
+                'fingerprint': self.fingerprints[resource].hexdigest(),
+                'breakdowns': self.breakdowns.get(resource) or None,
+            }
+            for resource, count in self.counts.items()
+        }
+
+def count_listing(listing, project_id):
+    """Runs one listing in one project page by page and returns its ListingCount results."""
+    resource = getattr(get_service(listing['api'], listing['version']), listing['collection'])()
+    tally = ListingCount(listing, project_id)
+    for page in iter_pages(resource, api=listing['api'], method=listing['method'], fields=listing['fields'],
+                           project=project_id, **listing['params']):
+        tally.add_page(page)
+    return tally.results()
+
+def count_resource(resource, project_id):
+    """Counts one resource in one project and returns its {'count', 'regions', 'fingerprint', 'breakdowns'}."""
+    return count_listing(plan_listings([resource])[0], project_id)[resource]
+
+def log_count_lines(lines, level=logging.INFO, fields=None):
+    """Default sink for a counter's log lines: the console. `fields` holds the same result as structured data."""
+    for line in lines:
+        logging.log(level, line)
+
+def record_results(record, log, project_id, results, duration=None):
+    """Records and logs the results of one listing: per-region counts first, then the project total
+    with its breakdowns."""
+    for resource, result in results.items():
+        label = get_definition(resource)['label']
+        breakdowns = result.get('breakdowns')
+        lines = []
+        for region, count in sorted((result['regions'] or {}).items()):
+            lines.append(f"{label} Count in {project_id} (region={region}): {count}")
+            record(project_id, resource, count, region=region)
+        lines.append(f"{label} Count in {project_id}: {result['count']}")
+        for field, counts in (breakdowns or {}).items():
+            lines.append(f"{label} Count in {project_id} by {field}: "
+                         + ', '.join(f"{value}={count}" for value, count in sorted(counts.items())))
+        record(project_id, resource, result['count'], fingerprint=result['fingerprint'], breakdowns=breakdowns)
+
+        fields = {'project_id': project_id, 'resource': resource, 'count': result['count']}
+        if result['regions'] is not None:
+            fields['regions'] = result['regions']
+        if breakdowns:
+            fields['breakdowns'] = breakdowns
+        if duration is not None:
+            fields['duration_seconds'] = round(duration, 3)
+        log(lines, fields=fields)
+
+def record_error(record, log, project_id, resources, error):
+    """Records and logs the failure of one listing against every resource it serves."""
+    for resource in resources:
+        record(project_id, resource, error=str(error))
+        log([f"Error counting {get_definition(resource)['label']}s in {project_id}: {error}"], level=logging.ERROR,
+            fields={'project_id': project_id, 'resource': resource, 'error': str(error)})
+
+def record_denied(record, log, project_id, resources, api, reason):
+    """Records and logs the resources of one listing left out because its calls are known to fail."""
+    get_metrics().inc('calls_skipped', service=api, reason=reason)
+    for resource in resources:
+        error = f"skipped: {api} {reason.replace('_', ' ')}"
+        record(project_id, resource, error=error)
+        log([f"Skipped {get_definition(resource)['label']}s in {project_id}: {api} {reason.replace('_', ' ')}"],
+            fields={'project_id': project_id, 'resource': resource, 'error': error})
+
+def make_counter(listing, record, log=log_count_lines, access=None):
+    """Builds a counter function for one listing, named count_<collection>, that takes a project ID.
+
+    Counts go to record(project_id, resource, count=None, region=None, error=None, fingerprint=None,
+    breakdowns=None), which matches RunReport.record; log lines go to log(lines, level=..., fields=...), where fields
+    holds the project, resource, count and listing duration as structured data. The counter returns
+    the number of items listed, and its `resources` attribute lists the resources it counts.
+
+    With an AccessCache as `access`, projects where the listing's API is disabled, its collection
+    cannot be listed or the project is gone are skipped until the denial expires, and such failures
+    are remembered.
+    """
+    resources = list(listing['matches'])
+    api, collection = listing['api'], listing['collection']
+
+    def counter(target_project_id):
+        # Leave out calls that failed for good on an earlier run
+        denial = access.denial(target_project_id, api, collection) if access is not None else None
+        if denial is not None:
+            record_denied(record, log, target_project_id, resources, api, denial[0])
+            return None
+
+        start = time.monotonic()
+        try:
+            results = count_listing(listing, target_project_id)
+        except Exception as e:
+            if access is not None:
+                access.observe(target_project_id, api, e, collection=collection)
+            record_error(record, log, target_project_id, resources, e)
+            return None
+        if access is not None:
+            access.allow(target_project_id, api, collection)
+        record_results(record, log, target_project_id, results, duration=time.monotonic() - start)
+        return sum(result['count'] for result in results.values())
+
+    counter.__name__ = 'count_' + re.sub(r'(?<!^)(?=[A-Z])', '_', listing['collection']).lower()
+    counter.resources = resources
+    return counter
+
+def count_plan_batched(calls, record, log=log_count_lines, access=None):
+    """Runs planned (project, listing) calls as batched HTTP requests, one batch stream per API.
+
+    Results are recorded and logged per call like make_counter does; returns {(project, resource): count}.
+    Calls denied in `access` (an AccessCache) are left out of the batches, and failed calls are
+    remembered there the same way.
+    """
+    if access is not None:
+        allowed = []
+        for project, listing in calls:
+            denial = access.denial(project, listing['api'], listing['collection'])
+            if denial is None:
+                allowed.append((project, listing))
+            else:
+                record_denied(record, log, project, list(listing['matches']), listing['api'], denial[0])
+        calls = allowed
+
+    # One ListingCount per call, fed page by page from the batch responses
+    tallies = {(project, index): ListingCount(listing, project) for index, (project, listing) in enumerate(calls)}
+    jobs_by_api = {}
+    for index, (project, listing) in enumerate(calls):
+        params = dict(listing['params'], project=project, fields=listing['fields'])
+        jobs_by_api.setdefault((listing['api'], listing['version']), []).append(
+            ((project, index), listing['collection'], listing['method'], listing['items_key'], params))
+
+    page_counts, errors = {}, {}
+    for (api, version), jobs in jobs_by_api.items():
+        try:
+            page_counts.update(count_in_batches(get_service(api, version), jobs, api=api,
+                                                on_page=lambda key, page: tallies[key].add_page(page), errors=errors))
+        except Exception as e:
+            logging.error(f"Error counting {api} resources in batch mode: {e}")
+            errors.update({key: e for key, *_ in jobs})
+
+    counts = {}
+    for index, (project, listing) in enumerate(calls):
+        if page_counts.get((project, index)) is None:
+            error = errors.get((project, index), 'batch request failed')
+            # Only a call's own failure says something about the project; a failed batch does not
+            if access is not None and (project, index) in page_counts:
+                access.observe(project, listing['api'], error, collection=listing['collection'])
+            record_error(record, log, project, list(listing['matches']), error)
+            continue
+        if access is not None:
+            access.allow(project, listing['api'], listing['collection'])
+        results = tallies[(project, index)].results()
+        record_results(record, log, project, results)
+        counts.update({(project, resource): result['count'] for resource, result in results.items()})
+    return counts
@@ -0,0 +1,204 @@
+import logging
+import os
+import tempfile
+import threading
+
+# Prefix of every exported metric name
+metrics_namespace = 'network_summary'
+
+# Upper bounds (seconds) of the latency histogram buckets
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Help text of every metric, keyed by name without the namespace
+metric_help = {
+    'api_requests': "API calls made, by outcome (each retry attempt counts once)",
+    'api_request_duration_seconds': "Latency of single API call attempts",
+    'api_retries': "API calls retried after a quota or transient error",
+    'api_throttled': "API calls rejected for quota (429 / RESOURCE_EXHAUSTED)",
+    'list_pages': "List response pages fetched",
+    'response_bytes': "Response body bytes received from discovery-based APIs",
+    'count_job_duration_seconds': "Wall time of one (project, resource) count",
+    'project_sweep_seconds': "Total count time spent on each project",
+    'log_entries': "Cloud Logging entries, by outcome (written, spilled to disk or dropped)",
+    'calls_skipped': "List calls left out because the API is disabled, access is denied or the project is gone",
+}
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+class RuntimeMetrics:
+    """Thread-safe counters and latency histograms for one process, exportable as OpenMetrics text."""
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or latency_buckets)
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Adds `value` to the counter `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """Records one duration in the histogram `name` with the given labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def snapshot(self, reset=False):
+        """Returns a picklable copy of every counter and histogram, e.g. to send to another process; with
+        `reset`, starts over from zero so the same counts are never handed over twice."""
+        with self._lock:
+            snapshot = {'counters': dict(self._counters),
+                        'histograms': {key: dict(h, buckets=list(h['buckets'])) for key, h in self._histograms.items()}}
+            if reset:
+                self._counters, self._histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Adds the counters and histograms of another process's snapshot() to these."""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, other in snapshot['histograms'].items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                histogram['buckets'] = [a + b for a, b in zip(histogram['buckets'], other['buckets'])]
+                histogram['sum'] += other['sum']
+                histogram['count'] += other['count']
+
+    def counter(self, name, **labels):
+        """Returns the sum of every series of counter `name` whose labels include `labels`."""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(value for (metric, key), value in self._counters.items()
+                       if metric == name and wanted <= set(key))
+
+    def quantile(self, name, fraction, **labels):
+        """Estimates a quantile of histogram `name` as the upper bound of the bucket it falls in."""
+        wanted = set(labels.items())
+        with self._lock:
+            matching = [h for (metric, key), h in self._histograms.items() if metric == name and wanted <= set(key)]
+        total = sum(h['count'] for h in matching)
+        if not total:
+            return None
+        seen = 0
+        for index, bound in enumerate(self.buckets):
+            seen += sum(h['buckets'][index] for h in matching)
+            if seen >= fraction * total:
+                return bound
+        return float('inf')
+
+    def render(self):
+        """Returns every metric in the OpenMetrics text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(h, buckets=list(h['buckets'])) for key, h in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            full_name = f"{metrics_namespace}_{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            lines.append(f"# HELP {full_name} {metric_help.get(name, name)}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{full_name}_total{_label_text(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            full_name = f"{metrics_namespace}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            lines.append(f"# HELP {full_name} {metric_help.get(name, name)}")
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                # Histogram buckets are cumulative in the exposition format
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram['buckets']):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_bucket{_label_text(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{full_name}_sum{_label_text(labels)} {histogram['sum']}")
+                lines.append(f"{full_name}_count{_label_text(labels)} {histogram['count']}")
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the OpenMetrics text to `path` atomically, e.g. for the node_exporter textfile collector."""
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            f.write(self.render())
+        os.replace(f.name, path)
+
+    def serve(self, port, host='0.0.0.0'):
+        """Serves the OpenMetrics text on http://host:port/metrics from a background thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving runtime metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def summary(self, slowest_projects=10):
+        """Returns a per-API table of calls, errors, retries, pages, bytes and latency, then the slowest projects."""
+        with self._lock:
+            services = sorted({dict(labels)['service'] for name, labels in list(self._counters) + list(self._histograms)
+                               if name.startswith(('api_', 'list_pages', 'response_bytes')) and 'service' in dict(labels)})
+            project_seconds = {dict(labels)['project']: value for (name, labels), value in self._counters.items()
+                               if name == 'project_sweep_seconds'}
+
+        def latency(value):
+            return '-' if value is None else f"<={value * 1000:.0f}ms"
+
+        lines = [f"{'API':20} {'calls':>8} {'errors':>8} {'retries':>8} {'throttled':>9} {'pages':>8} "
+                 f"{'bytes':>12} {'p50':>10} {'p99':>10}"]
+        for service in services:
+            lines.append(
+                f"{service:20} {self.counter('api_requests', service=service, outcome='ok'):>8} "
+                f"{self.counter('api_requests', service=service, outcome='error'):>8} "
+                f"{self.counter('api_retries', service=service):>8} {self.counter('api_throttled', service=service):>9} "
+                f"{self.counter('list_pages', service=service):>8} {self.counter('response_bytes', service=service):>12} "
+                f"{latency(self.quantile('api_request_duration_seconds', 0.5, service=service)):>10} "
+                f"{latency(self.quantile('api_request_duration_seconds', 0.99, service=service)):>10}"
+            )
+
+        if project_seconds:
+            lines.append('')
+            lines.append(f"{'Slowest projects':40} {'seconds':>10}")
+            for project, seconds in sorted(project_seconds.items(), key=lambda p: -p[1])[:slowest_projects]:
+                lines.append(f"{project:40} {seconds:>10.2f}")
+        return '\n'.join(lines)
+
+_default_metrics = RuntimeMetrics()
+
+def get_metrics():
+    """Returns the process-wide runtime metrics."""
+    return _default_metrics
@@ -0,0 +1,124 @@
+import csv
+import gzip
+import io
+import json
+import logging
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+# Reports up to this size are built in memory and sent in one request; larger ones
+# spill to a temporary file and go up as a chunked resumable upload
+resumable_threshold = 8 * 1024 * 1024
+
+# Resumable upload chunk size (must be a multiple of 256 KiB)
+upload_chunk_size = 8 * 1024 * 1024
+
+report_fields = ['run_id', 'project_id', 'resource', 'region', 'count', 'error', 'fingerprint', 'breakdowns']
+
+class RunReport:
+    """Buffers every count made during a run so they can be written as one object."""
+
+    def __init__(self):
+        self.run_id = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        self._records = []
+        self._lock = threading.Lock()
+        # Optional SweepJournal that every new record is also appended to as it is made
+        self.journal = None
+
+    def record(self, project_id, resource, count=None, region=None, error=None, fingerprint=None, breakdowns=None):
+        """Adds one count (or the error that prevented it) to the report; project totals may carry their
+        breakdowns as {field: {value: count}}."""
+        record = {
+            'run_id': self.run_id,
+            'project_id': project_id,
+            'resource': resource,
+            'region': region,
+            'count': count,
+            'error': error,
+            'fingerprint': fingerprint,
+            'breakdowns': breakdowns,
+        }
+        with self._lock:
+            self._records.append(record)
+        if self.journal is not None:
+            self.journal.write(record)
+
+    def extend(self, records):
+        """Merges records counted elsewhere (another process, shard or machine) into this run's report."""
+        with self._lock:
+            self._records.extend(dict(record, run_id=self.run_id) for record in records)
+
+    def retain(self, keys):
+        """Drops the counts for every (project, resource) not in `keys`; errors are always kept."""
+        with self._lock:
+            self._records = [r for r in self._records
+                             if r['error'] is not None or (r['project_id'], r['resource']) in keys]
+
+    def keep_latest(self):
+        """Keeps only the most recent count of each (project, resource): its project total and the region
+        counts recorded with it, so a job that ran more than once since the report started appears once."""
+        with self._lock:
+            # Region counts are recorded before the total (or error) that ends the same count
+            pending, latest = {}, {}
+            for record in self._records:
+                key = (record['project_id'], record['resource'])
+                if record['region'] is not None:
+                    pending.setdefault(key, []).append(record)
+                else:
+                    latest[key] = pending.pop(key, []) + [record]
+
+            # Region counts of a count still running belong with its total, which has not arrived yet
+            for key, records in pending.items():
+                latest.setdefault(key, records)
+            self._records = [record for records in latest.values() for record in records]
+
+    def records(self):
+        """Returns the buffered records sorted by project, resource and region."""
+        with self._lock:
+            records = list(self._records)
+        return sorted(records, key=lambda r: (r['project_id'], r['resource'], r['region'] or ''))
+
+    def write(self, f, fmt='jsonl'):
+        """Writes the report to a text file object as JSON Lines or CSV."""
+        records = self.records()
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=report_fields)
+            writer.writeheader()
+            # Breakdowns are nested, so they go into their CSV column as JSON
+            writer.writerows(dict(record, breakdowns=json.dumps(record['breakdowns'], sort_keys=True))
+                             if record.get('breakdowns') else record for record in records)
+        else:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return len(records)
+
+    def upload(self, storage_client, bucket_name, blob_prefix, fmt='jsonl', compress=False):
+        """Uploads the whole report as a single object named after the run and returns its name."""
+        blob_name = f"{blob_prefix}/{self.run_id}.{fmt}" + ('.gz' if compress else '')
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+
+        with tempfile.SpooledTemporaryFile(max_size=resumable_threshold) as spool:
+            # Serialize straight into the spool, through gzip if asked, so large reports never sit in memory twice
+            raw = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+            text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+            record_count = self.write(text, fmt)
+            text.flush()
+            text.detach()
+            if compress:
+                raw.close()
+
+            size = spool.tell()
+            spool.seek(0)
+
+            if size > resumable_threshold:
+                # Setting a chunk size switches the client to a resumable upload
+                blob.chunk_size = upload_chunk_size
+            if compress:
+                blob.content_encoding = 'gzip'
+
+            content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+            blob.upload_from_file(spool, size=size, content_type=content_type)
+
+        logging.info(f"Wrote {record_count} counts ({size} bytes) to gs://{bucket_name}/{blob_name}")
+        return blob_name
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+
+from rate_limit import get_governor, parse_rate_limits
+from run_metrics import get_metrics
+
+# Seconds a worker may hold claimed projects before another worker can take them over
+default_lease_seconds = 15 * 60
+
+# Projects are given up on after being claimed this many times without completing
+default_max_attempts = 3
+
+def shard_of(project_id, shard_count):
+    """Returns the shard a project belongs to; stable across runs, machines and Python versions."""
+    digest = hashlib.sha256(project_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shard_count
+
+def shard_projects(projects, shard_index, shard_count):
+    """Returns the projects of one shard, in their original order."""
+    return [project for project in projects if shard_of(project, shard_count) == shard_index]
+
+def _init_process(processes, rate_limits):
+    """Applies the parent's per-API limits in a worker process, then takes its 1/processes share of them."""
+    for service, limit in parse_rate_limits(rate_limits).items():
+        get_governor().configure(service, rate=limit['rate'], concurrency=limit.get('concurrency'))
+    get_governor().share(processes)
+
+def _pool(processes, rate_limits):
+    # Fresh interpreters rather than forks, so no gRPC channel, lock or HTTP connection is inherited
+    return multiprocessing.get_context('spawn').Pool(processes, initializer=_init_process,
+                                                     initargs=(processes, list(rate_limits or [])))
+
+def _with_metrics(job):
+    """Runs worker(argument) in a worker process and returns its result with the metrics it collected."""
+    worker, argument = job
+    result = worker(argument)
+    # A pool process may run several jobs, so each one hands over only what it added
+    return result, get_metrics().snapshot(reset=True)
+
+def _merge_metrics(results):
+    """Adds the worker processes' metrics to this process's and returns their results alone."""
+    for _, snapshot in results:
+        get_metrics().merge(snapshot)
+    return [result for result, _ in results]
+
+def run_in_processes(projects, worker, processes, rate_limits=None):
+    """Splits projects into `processes` hash shards, runs worker(shard) in one process each and returns
+    every process's records in one list; their runtime metrics are added to this process's.
+
+    `worker` must be a module-level function that returns a list of run report records. The processes
+    share the API quota: each gets 1/processes of the limits set with `rate_limits` ('API=RATE[:CONCURRENCY]').
+    """
+    shards = [shard_projects(projects, index, processes) for index in range(processes)]
+    shards = [shard for shard in shards if shard]
+    if not shards:
+        return []
+    logging.info(f"Counting {len(projects)} projects in {len(shards)} processes "
+                 f"(shard sizes {', '.join(str(len(shard)) for shard in shards)})")
+
+    with _pool(len(shards), rate_limits) as pool:
+        results = _merge_metrics(pool.map(_with_metrics, [(worker, shard) for shard in shards]))
+    return [record for records in results for record in records]
+
+def _work_queue(job):
+    path, lease_seconds, max_attempts, run_id, count_projects, batch_size = job
+    queue = WorkQueue(path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return queue.work(run_id, count_projects, batch_size)
+
+def work_in_processes(queue, run_id, count_projects, processes, batch_size=50, rate_limits=None):
+    """Runs `processes` queue workers on this machine until the run has nothing left to claim; returns
+    the number of projects they counted. Their runtime metrics are added to this process's."""
+    if processes <= 1:
+        return queue.work(run_id, count_projects, batch_size)
+    job = (queue.path, queue.lease_seconds, queue.max_attempts, run_id, count_projects, batch_size)
+    with _pool(processes, rate_limits) as pool:
+        return sum(_merge_metrics(pool.map(_with_metrics, [(_work_queue, job)] * processes)))
+
+class WorkQueue:
+    """SQLite-backed queue that hands out projects to workers on one or many machines.
+
+    Workers claim projects under a lease, count them and store their records; projects whose lease
+    expires (e.g. the worker died) are handed out again. The file must be on storage every worker can
+    lock, such as a local disk for several processes or a shared volume for several machines.
+    """
+
+    def __init__(self, path, lease_seconds=default_lease_seconds, max_attempts=default_max_attempts):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, created REAL)")
+            db.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                              run_id TEXT, project_id TEXT, shard INTEGER, state TEXT, worker TEXT,
+                              lease_expires REAL, attempts INTEGER DEFAULT 0, records TEXT,
+                              PRIMARY KEY (run_id, project_id))""")
+
+    def _connect(self):
+        # Autocommit mode, so claims can take the write lock up front with BEGIN IMMEDIATE
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def enqueue(self, run_id, projects, shard_count=64):
+        """Adds a run's projects to the queue; projects already queued for the run are left as they are."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("INSERT OR IGNORE INTO runs VALUES (?, ?)", (run_id, time.time()))
+            db.executemany("INSERT OR IGNORE INTO tasks (run_id, project_id, shard, state) VALUES (?, ?, ?, 'pending')",
+                           [(run_id, project, shard_of(project, shard_count)) for project in projects])
+            db.execute("COMMIT")
+        logging.info(f"Queued {len(projects)} projects for run {run_id} in {self.path}")
+
+    def latest_run(self):
+        """Returns the ID of the most recently queued run, or None."""
+        with self._connect() as db:
+            row = db.execute("SELECT run_id FROM runs ORDER BY created DESC LIMIT 1").fetchone()
+        return row[0] if row else None
+
+    def claim(self, run_id, limit=50):
+        """Leases up to `limit` pending (or abandoned) projects to this worker and returns them."""
+        now = time.time()
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            # Projects of the same hash shard are claimed together, so each worker gets a stable slice
+            projects = [row[0] for row in db.execute(
+                """SELECT project_id FROM tasks
+                   WHERE run_id = ? AND attempts < ?
+                     AND (state = 'pending' OR (state = 'leased' AND lease_expires < ?))
+                   ORDER BY shard, project_id LIMIT ?""",
+                (run_id, self.max_attempts, now, limit))]
+            db.executemany(
+                """UPDATE tasks SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                   WHERE run_id = ? AND project_id = ?""",
+                [(self.worker_id, now + self.lease_seconds, run_id, project) for project in projects])
+            db.execute("COMMIT")
+        return projects
+
+    def complete(self, run_id, records_by_project):
+        """Stores the records of projects this worker counted; late results for re-leased projects are dropped."""
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                """UPDATE tasks SET state = 'done', records = ?
+                   WHERE run_id = ? AND project_id = ? AND worker = ? AND state = 'leased'""",
+                [(json.dumps(records), run_id, project, self.worker_id)
+                 for project, records in records_by_project.items()])
+            db.execute("COMMIT")
+
+    def progress(self, run_id):
+        """Returns {'pending', 'leased', 'done', 'failed'} project counts for a run."""
+        with self._connect() as db:
+            rows = db.execute(
+                """SELECT CASE WHEN state != 'done' AND attempts >= ? AND
+                                    (state = 'pending' OR lease_expires < ?) THEN 'failed' ELSE state END,
+                          COUNT(*)
+                   FROM tasks WHERE run_id = ? GROUP BY 1""",
+                (self.max_attempts, time.time(), run_id)).fetchall()
+        progress = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+        progress.update(dict(rows))
+        return progress
+
+    def records(self, run_id):
+        """Returns the records of every completed project of a run, merged into one list."""
+        with self._connect() as db:
+            rows = db.execute("SELECT records FROM tasks WHERE run_id = ? AND state = 'done'", (run_id,)).fetchall()
+        return [record for (records,) in rows for record in json.loads(records)]
+
+    def work(self, run_id, count_projects, batch_size=50):
+        """Claims and counts batches of projects until none are left; count_projects(projects) returns records."""
+        counted = 0
+        while True:
+            projects = self.claim(run_id, batch_size)
+            if not projects:
+                return counted
+            records = count_projects(projects)
+
+            # Store each project's records separately, so a project is either fully merged or retried
+            records_by_project = {project: [] for project in projects}
+            for record in records:
+                records_by_project.setdefault(record['project_id'], []).append(record)
+            self.complete(run_id, records_by_project)
+            counted += len(projects)
+            logging.info(f"Counted {counted} projects of run {run_id}: {self.progress(run_id)}")
+
+    def wait(self, run_id, poll_interval=10, timeout=None):
+        """Blocks until no project of the run is pending or leased; returns the final progress."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            progress = self.progress(run_id)
+            if not progress['pending'] and not progress['leased']:
+                return progress
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.warning(f"Gave up waiting for run {run_id}: {progress}")
+                return progress
+            time.sleep(poll_interval)
@@ -0,0 +1,49 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from run_metrics import get_metrics
+
+# Default number of (project, resource) jobs allowed to run at the same time
+default_max_workers = 16
+
+def _timed(counter, project):
+    """Runs one count and records how long it took, per counter and per project."""
+    start = time.monotonic()
+    try:
+        return counter(project)
+    finally:
+        elapsed = time.monotonic() - start
+        get_metrics().observe('count_job_duration_seconds', elapsed, counter=counter.__name__)
+        get_metrics().inc('project_sweep_seconds', elapsed, project=project)
+
+def run_sweep(projects, counters, max_workers=default_max_workers, skip=None):
+    """Runs every counter against every project on a bounded worker pool and returns the results in job order.
+
+    `skip(project, counter)` can return True to leave a job out of this run.
+    """
+    # One job per (project, counter) pair, in the same order the sequential loop would run them
+    jobs = [(project, counter) for project in projects for counter in counters
+            if skip is None or not skip(project, counter)]
+    if not jobs:
+        return []
+
+    # Never start more threads than there are jobs
+    worker_count = max(1, min(max_workers, len(jobs)))
+    logging.info(f"Running {len(jobs)} count jobs across {len(projects)} projects with {worker_count} workers")
+
+    with ThreadPoolExecutor(max_workers=worker_count) as executor:
+        futures = [executor.submit(_timed, counter, project) for project, counter in jobs]
+
+        # Collect results in submission order so the output does not depend on completion order
+        results = []
+        for (project, counter), future in zip(jobs, futures):
+            try:
+                count = future.result()
+            except Exception as e:
+                # The counters log their own API errors; this only catches unexpected failures
+                logging.error(f"Error running {counter.__name__} for {project}: {e}")
+                count = None
+            results.append((project, counter.__name__, count))
+
+    return results
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+import time
+
+# Where interrupted sweeps leave their journals, one file per script
+journal_dir = os.environ.get(
+    'SWEEP_JOURNAL_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'journals')
+)
+
+# Journal lines reach the disk at least this often (every line reaches the OS as soon as it is written)
+fsync_interval = 1.0
+
+def journal_path(name):
+    """Returns the default journal file of a script."""
+    return os.path.join(journal_dir, f"{name}.journal.jsonl")
+
+def completed_jobs(records):
+    """Returns the (project, resource) pairs whose project total was counted without error."""
+    return {(r['project_id'], r['resource']) for r in records
+            if r['region'] is None and r['error'] is None and r['count'] is not None}
+
+class SweepJournal:
+    """Append-only file of every count made during a sweep, so an interrupted sweep can resume where it stopped.
+
+    The first line names the run; every later line is one run report record. Several processes may
+    append to the same journal, since each record is written as a single line in append mode.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+        self._synced = time.monotonic()
+
+    def _read(self):
+        """Returns (run_id, records) from the journal file, or (None, []) if there is none."""
+        try:
+            with open(self.path) as f:
+                text = f.read()
+        except OSError:
+            return None, []
+        header, _, body = text.partition('\n')
+        try:
+            run_id = json.loads(header)['run_id']
+        except (ValueError, KeyError):
+            # Without its header line the journal cannot be tied to a run
+            return None, []
+        # Every write ends its line, so a missing final newline means the process died while writing it
+        if not body.endswith('\n'):
+            body = body.rpartition('\n')[0]
+        body = body.strip('\n')
+        if not body:
+            return run_id, []
+        try:
+            # One parse for the whole file is several times faster than one per line
+            return run_id, json.loads('[' + body.replace('\n', ',') + ']')
+        except ValueError:
+            pass
+
+        # Otherwise keep every intact line
+        records = []
+        for line in body.split('\n'):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+        return run_id, records
+
+    def start(self, run_id, resume=False):
+        """Opens the journal for a run and returns (run_id, records made so far).
+
+        With `resume`, an existing journal is continued: its run ID and records are returned and
+        new records are appended. Otherwise any old journal is replaced by an empty one for `run_id`.
+        """
+        records = []
+        if resume:
+            journal_run_id, records = self._read()
+            if journal_run_id is not None:
+                run_id = journal_run_id
+                logging.info(f"Resuming run {run_id} from {self.path}: "
+                             f"{len(completed_jobs(records))} (project, resource) counts already done")
+            else:
+                logging.info(f"No journal to resume in {self.path}, starting run {run_id}")
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if not records:
+            with open(self.path, 'w') as f:
+                f.write(json.dumps({'run_id': run_id}) + '\n')
+        else:
+            self._drop_torn_line()
+        self._file = open(self.path, 'a')
+        return run_id, records
+
+    def _drop_torn_line(self):
+        """Cuts off a last line left unfinished by a crash, so appended records start on a line of their own."""
+        with open(self.path, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            f.seek(max(0, size - 65536))
+            tail = f.read()
+            if not tail.endswith(b'\n') and b'\n' in tail:
+                f.truncate(size - len(tail) + tail.rindex(b'\n') + 1)
+
+    def open(self):
+        """Opens an already started journal for appending, e.g. in a worker process."""
+        self._file = open(self.path, 'a')
+        return self
+
+    def write(self, record):
+        """Appends one record; it survives the process dying as soon as this returns."""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if time.monotonic() - self._synced >= fsync_interval:
+                os.fsync(self._file.fileno())
+                self._synced = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def finish(self):
+        """Closes and removes the journal once the run's results have been written out."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logging.warning(f"Could not remove sweep journal {self.path}: {e}")
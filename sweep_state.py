@@ -0,0 +1,66 @@
+import json
+import logging
+import os
+import time
+
+# Where the last fingerprint and breakdowns of every (project, resource) listing are kept between runs
+sweep_state_path = os.environ.get(
+    'SWEEP_STATE_FILE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'network-summary-count', 'sweep_state.json')
+)
+
+class SweepState:
+    """Remembers the last count, listing fingerprint and breakdowns per (project, resource) between runs."""
+
+    def __init__(self, path=sweep_state_path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self._state = json.load(f)
+        except (OSError, ValueError):
+            self._state = {}
+
+    def is_fresh(self, project_id, resource, max_age):
+        """Returns True if the resource was checked less than `max_age` seconds ago."""
+        entry = self._state.get(project_id, {}).get(resource)
+        return bool(max_age) and entry is not None and time.time() - entry['checked'] < max_age
+
+    def apply(self, report):
+        """Updates the state from a run report and returns the (project, resource) pairs whose listing changed."""
+        now = time.time()
+        changed = set()
+        for record in report.records():
+            # Project totals carry the fingerprint; region breakdowns and errors do not update the state
+            if record['region'] is not None or record['error'] is not None:
+                continue
+
+            # Counts made without a fingerprint (e.g. in batch mode) fall back to comparing the count
+            fingerprint = record['fingerprint'] or f"count:{record['count']}"
+            project_state = self._state.setdefault(record['project_id'], {})
+            previous = project_state.get(record['resource'])
+            if previous is None or previous['fingerprint'] != fingerprint:
+                changed.add((record['project_id'], record['resource']))
+
+            # Breakdowns (e.g. tunnel status) change without the IDs changing; counts without them
+            # (e.g. from the asset backend) keep the previous ones
+            breakdowns = record.get('breakdowns')
+            previous_breakdowns = previous.get('breakdowns') if previous is not None else None
+            if breakdowns is None:
+                breakdowns = previous_breakdowns
+            elif previous_breakdowns is not None and previous_breakdowns != breakdowns:
+                changed.add((record['project_id'], record['resource']))
+
+            project_state[record['resource']] = {'fingerprint': fingerprint, 'count': record['count'], 'checked': now,
+                                                 'breakdowns': breakdowns}
+        return changed
+
+    def save(self):
+        """Writes the state file atomically."""
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._state, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Could not write sweep state {self.path}: {e}")
@@ -1,8 +1,24 @@
+import argparse
+import functools
 import logging
-from googleapiclient.discovery import build
-from google.auth import default
-from google.cloud import storage
-from google.cloud import resourcemanager_v3
+import sys
+from access_cache import get_access_cache, precheck_services
+from asset_inventory import compare_reports, count_with_assets
+from count_history import CountHistory, count_history_path
+from gcp_clients import (get_credentials, get_default_project_id, get_discovery_document, get_metric_client,
+                         get_storage_client, known_apis)
+from metric_registry import breakdown_metric_name, ensure_metric_descriptors, metric_type, total_region
+from metric_writer import MetricWriter
+from project_inventory import build_project_query, discover_projects
+from rate_limit import get_governor, parse_rate_limits
+from resource_registry import (count_plan_batched, get_definition, make_counter, plan_calls, plan_listings,
+                               resource_names)
+from run_metrics import get_metrics
+from run_report import RunReport
+from sharding import run_in_processes
+from sweep_executor import default_max_workers, run_sweep
+from sweep_journal import SweepJournal, completed_jobs, journal_path
+from sweep_state import SweepState, sweep_state_path
 
 # Configure logging to send logs to the console and a log sink
 logging.basicConfig(
@@ -13,193 +29,207 @@ logging.basicConfig(
     ]
 )
 
-# Configure Cloud Storage
-storage_client = storage.Client()
+# Configure Cloud Storage (the client itself is created when the report is uploaded)
 bucket_name = 'metric-count'  # Replace with your Cloud Storage bucket name
-blob_name = 'vpn_tunnel_counts.txt'  # Replace with your desired blob name
-
-def count_vpn_tunnels(target_project_id):
-    """Counts VPN Tunnels in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # Specify the region for VPN Tunnels
-        region = 'us-central1'  # Replace with your actual region
-
-        # List VPN Tunnels in the target project and region
-        response = service.vpnTunnels().list(project=target_project_id, region=region).execute()
-        vpn_tunnel_count = len(response.get('items', []))
-
-        # Log the VPN Tunnel count to the console
-        logging.info(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}")
-
-        # Write the VPN Tunnel count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPN Tunnel Count in {target_project_id}: {vpn_tunnel_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting VPN Tunnels in {target_project_id}: {e}")
-
-def count_vpcs(target_project_id):
-    """Counts VPCs in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # List VPCs in the target project
-        response = service.networks().list(project=target_project_id).execute()
-        vpc_count = len(response.get('items', []))
-
-        # Log the VPC count to the console
-        logging.info(f"VPC Count in {target_project_id}: {vpc_count}")
-
-        # Write the VPC count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPC Count in {target_project_id}: {vpc_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting VPCs in {target_project_id}: {e}")
-
-def count_dns_zones(target_project_id):
-    """Counts DNS Zones in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the DNS service
-        service = build('dns', 'v1', credentials=credentials)
-
-        # List DNS Zones in the target project
-        response = service.managedZones().list(project=target_project_id).execute()
-        dns_zone_count = len(response.get('managedZones', []))
-
-        # Log the DNS Zone count to the console
-        logging.info(f"DNS Zone Count in {target_project_id}: {dns_zone_count}")
-
-        # Write the DNS Zone count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"DNS Zone Count in {target_project_id}: {dns_zone_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting DNS Zones in {target_project_id}: {e}")
-
-def count_cloud_routers(target_project_id):
-    """Counts Cloud Routers in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # Specify the region for Cloud Routers
-        region = 'us-central1'  # Replace with your actual region
-
-        # List Cloud Routers in the target project and region
-        response = service.routers().list(project=target_project_id, region=region).execute()
-        cloud_router_count = len(response.get('items', []))
-
-        # Log the Cloud Router count to the console
-        logging.info(f"Cloud Router Count in {target_project_id}: {cloud_router_count}")
-
-        # Write the Cloud Router count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"Cloud Router Count in {target_project_id}: {cloud_router_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting Cloud Routers in {target_project_id}: {e}")
-
-def count_vpc_peerings(target_project_id):
-    """Counts VPC Peerings in the target project and writes the count to the log."""
+report_prefix = 'network-summary'  # Each run writes one report object under this prefix
+
+# Every count made during this run, written to Cloud Storage as one object at the end
+run_report = RunReport()
+
+def record_count(project_id, resource, count=None, region=None, error=None, fingerprint=None, breakdowns=None):
+    """Adds one count to the current run report (looked up on every call, so it can be swapped between cycles)."""
+    run_report.record(project_id, resource, count, region=region, error=error, fingerprint=fingerprint,
+                      breakdowns=breakdowns)
+
+def build_counters(resources=None, access=None):
+    """Returns one counter per listing needed for `resources` (every registered resource by default).
+
+    Resources read from the same collection (e.g. VPCs and their peerings) share one counter and its
+    calls. The counters skip projects where their API is known to be disabled or denied, as remembered
+    in `access` (the process-wide AccessCache by default).
+    """
+    access = access or get_access_cache()
+    return [make_counter(listing, record_count, access=access) for listing in plan_listings(resources)]
+
+# Counters for every registered resource, with the report resources each one counts
+counter_resources = {counter: counter.resources for counter in build_counters()}
+
+def recheck_skip(sweep_state, recheck_after):
+    """Returns a run_sweep skip function that leaves out counters whose resources were all checked recently."""
+    return lambda project, counter: all(sweep_state.is_fresh(project, resource, recheck_after)
+                                        for resource in counter.resources)
+
+def done_skip(done):
+    """Returns a run_sweep skip function that leaves out counters whose resources were all counted already."""
+    return lambda project, counter: all((project, resource) in done for resource in counter.resources)
+
+def completed_listings(done, resources=None):
+    """Returns the pairs in `done` whose whole listing was counted; a listing with any resource missing
+    is counted again in full, so its other resources are not done either."""
+    listings = plan_listings(resources)
+    return {(project, resource) for project in {project for project, _ in done} for listing in listings
+            if all((project, match) in done for match in listing['matches']) for resource in listing['matches']}
+
+def any_skip(*skips):
+    """Combines run_sweep skip functions; None entries are ignored and None is returned if none are left."""
+    skips = [skip for skip in skips if skip is not None]
+    if not skips:
+        return None
+    return lambda project, counter: any(skip(project, counter) for skip in skips)
+
+def count_projects(projects, resources=None, workers=default_max_workers, state_file=None, recheck_after=0,
+                   journal_file=None, done=None, recheck_denied=False):
+    """Counts `resources` in a list of projects on a thread pool and returns their run report records.
+
+    Used as the worker of a multi-process sweep, so it starts from an empty report every time. Records
+    are also appended to `journal_file`, and the (project, resource) pairs in `done` are skipped.
+    """
+    global run_report
+    run_report = RunReport()
+    get_access_cache().recheck = recheck_denied
+    if journal_file:
+        run_report.journal = SweepJournal(journal_file).open()
+    skip = any_skip(recheck_skip(SweepState(state_file), recheck_after) if state_file and recheck_after else None,
+                    done_skip(done) if done else None)
     try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # List VPC Peerings in the target project
-        response = service.globalAddresses().list(project=target_project_id).execute()
-        vpc_peering_count = len(response.get('items', []))
-
-        # Log the VPC Peering count to the console
-        logging.info(f"VPC Peering Count in {target_project_id}: {vpc_peering_count}")
-
-        # Write the VPC Peering count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"VPC Peering Count in {target_project_id}: {vpc_peering_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting VPC Peerings in {target_project_id}: {e}")
-
-def count_firewalls(target_project_id):
-    """Counts Firewalls in the target project and writes the count to the log."""
+        run_sweep(projects, build_counters(resources), max_workers=workers, skip=skip)
+    finally:
+        if run_report.journal is not None:
+            run_report.journal.close()
+    return run_report.records()
+
+def count_all_batched(projects, resources=None, done=None, access=None):
+    """Counts every resource type in every project with batched list calls and adds the counts to the run report.
+
+    Listings whose resources are all in `done` (project, resource) pairs are left out, and so are the
+    calls denied in `access` (the process-wide AccessCache by default).
+    """
+    calls = plan_calls(projects, resources)
+    if done:
+        calls = [(project, listing) for project, listing in calls
+                 if not all((project, resource) in done for resource in listing['matches'])]
+    # A batch request can only target one API; the plan is already grouped by API
+    return count_plan_batched(calls, record_count, access=access or get_access_cache())
+
+def count_all_with_assets(projects, resources=None, scope=None, done=None):
+    """Counts every resource type in every project with Cloud Asset Inventory searches and adds the counts to the run report.
+
+    The (project, resource) pairs in `done` are left out.
+    """
+    return count_with_assets(projects, record_count, resources=resources, scope=scope, done=done)
+
+def cross_check(projects, resources=None, scope=None):
+    """Counts again with Cloud Asset Inventory and returns how those counts differ from the run report's."""
+    asset_report = RunReport()
+    count_with_assets(projects, asset_report.record, log=lambda lines, level=logging.INFO, fields=None: None,
+                      resources=resources, scope=scope)
+    return compare_reports(run_report, asset_report)
+
+def publish_metrics(report):
+    """Writes every count in the run report, and its breakdowns, to Cloud Monitoring with batched
+    create_time_series calls."""
+    # Create or update only the descriptors that are missing or have drifted
+    ensure_metric_descriptors(get_metric_client(), get_default_project_id())
+
+    metric_writer = MetricWriter(get_metric_client(), get_default_project_id())
+    records = [record for record in report.records() if record['error'] is None]
+
+    # Regional resources are published per region plus a project total labelled region='all', which keeps
+    # showing a drop to 0 after the regions have no items left; everything else as a project total
+    for record in records:
+        record_metric_type = metric_type(f"{record['resource']}_count")
+        if record['region']:
+            metric_writer.add(record_metric_type, record['count'], record['project_id'], region=record['region'])
+        elif get_definition(record['resource'])['scope'] == 'regional':
+            metric_writer.add(record_metric_type, record['count'], record['project_id'], region=total_region)
+        else:
+            metric_writer.add(record_metric_type, record['count'], record['project_id'])
+
+        # Breakdowns ride on the project total and become one labelled series per value
+        for field, counts in (record.get('breakdowns') or {}).items():
+            for value, count in counts.items():
+                metric_writer.add(metric_type(breakdown_metric_name(record['resource'], field)), count,
+                                  record['project_id'], **{field: value})
+
+    return metric_writer.flush()
+
+def check_setup(projects):
+    """Verifies credentials and discovery documents without counting anything; returns True when ready to run."""
+    ready = True
     try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
-
-        # Build the Compute Engine service
-        service = build('compute', 'v1', credentials=credentials)
-
-        # List Firewalls in the target project
-        response = service.firewalls().list(project=target_project_id).execute()
-        firewall_count = len(response.get('items', []))
-
-        # Log the Firewall count to the console
-        logging.info(f"Firewall Count in {target_project_id}: {firewall_count}")
-
-        # Write the Firewall count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"Firewall Count in {target_project_id}: {firewall_count}\n",
-                                 content_type='text/plain')
-
+        get_credentials()
+        logging.info(f"Credentials OK (default project {get_default_project_id()})")
     except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting Firewalls in {target_project_id}: {e}")
+        logging.error(f"Cannot load credentials: {e}")
+        ready = False
 
-def count_private_service_access_ranges(target_project_id):
-    """Counts Private Service Access Ranges in the target project and writes the count to the log."""
-    try:
-        # Authenticate with Google Cloud (using default credentials)
-        credentials, project_id = default()
+    # Loading the documents also fills the on-disk discovery cache for the real run
+    for api, version in known_apis:
+        try:
+            get_discovery_document(api, version)
+        except Exception as e:
+            logging.error(f"Cannot load the {api} {version} discovery document: {e}")
+            ready = False
 
-        # Build the Service Networking service
-        service = build('servicenetworking', 'v1', credentials=credentials)
-
-        # List Private Service Access Ranges in the target project
-        response = service.services().list(parent=f"projects/{target_project_id}").execute()
-        private_service_access_range_count = len(response.get('services', []))
-
-        # Log the Private Service Access Range count to the console
-        logging.info(f"Private Service Access Range Count in {target_project_id}: {private_service_access_range_count}")
-
-        # Write the Private Service Access Range count to Cloud Storage
-        blob = storage_client.bucket(bucket_name).blob(blob_name)
-        blob.upload_from_string(f"Private Service Access Range Count in {target_project_id}: {private_service_access_range_count}\n",
-                                 content_type='text/plain')
-
-    except Exception as e:
-        # Log the error to the console
-        logging.error(f"Error counting Private Service Access Ranges in {target_project_id}: {e}")
+    logging.info(f"{len(projects)} projects and {len(counter_resources)} counters configured")
+    return ready
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts network resources in each project.")
+    parser.add_argument('--workers', type=int, default=default_max_workers,
+                        help="Maximum number of (project, resource) counts to run at the same time")
+    parser.add_argument('--resource', action='append', choices=resource_names,
+                        help="Resource type to count (repeatable, defaults to every registered type)")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Split the projects by stable hash across this many worker processes")
+    parser.add_argument('--batch', action='store_true',
+                        help="Send the list calls as batched HTTP requests instead of one request per count")
+    parser.add_argument('--backend', choices=['list', 'asset'], default='list',
+                        help="Count with per-project list calls or with Cloud Asset Inventory searches")
+    parser.add_argument('--asset-scope', metavar='SCOPE',
+                        help="Organization or folder to search, e.g. organizations/123, so the asset backend "
+                             "needs one search for the whole fleet (otherwise one search per project)")
+    parser.add_argument('--cross-check', action='store_true',
+                        help="With the list backend, also count with the asset backend and log every count that differs")
+    parser.add_argument('--report-format', choices=['jsonl', 'csv'], default='jsonl',
+                        help="Format of the run report written to Cloud Storage")
+    parser.add_argument('--gzip', action='store_true', help="Gzip the run report")
+    parser.add_argument('--publish-metrics', action='store_true',
+                        help="Also write every count to Cloud Monitoring as custom metrics")
+    parser.add_argument('--discover', action='store_true',
+                        help="Count every ACTIVE project found by Resource Manager instead of the fixed list")
+    parser.add_argument('--project-label', action='append', default=[], metavar='KEY=VALUE',
+                        help="With --discover, only count projects with this label (repeatable)")
+    parser.add_argument('--project-contains', help="With --discover, only count project IDs containing this text")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only report and publish counts whose listing changed since the last run")
+    parser.add_argument('--state-file', default=sweep_state_path, help="Where --incremental keeps its state")
+    parser.add_argument('--recheck-after', type=int, default=0,
+                        help="With --incremental, skip resources checked less than this many seconds ago")
+    parser.add_argument('--rate-limit', action='append', default=[], metavar='API=RATE[:CONCURRENCY]',
+                        help="Calls per second (and most concurrent calls) allowed for an API, e.g. compute=20:16")
+    parser.add_argument('--check', action='store_true',
+                        help="Only check credentials and discovery documents, then exit (non-zero if not ready)")
+    parser.add_argument('--precheck-services', action='store_true',
+                        help="Look up the enabled APIs of each project first (one Service Usage call per project) "
+                             "and skip the listings of disabled ones")
+    parser.add_argument('--recheck-denied', action='store_true',
+                        help="Try projects and APIs remembered as disabled, denied or deleted again instead of skipping them")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the last interrupted run from its journal, counting only what it had not finished")
+    parser.add_argument('--journal', default=journal_path('network_summary'),
+                        help="Where each count is journaled as it is made, for --resume")
+    parser.add_argument('--history', nargs='?', const=count_history_path, metavar='PATH',
+                        help="Also add every count to the local history database used by count_history.py")
+    parser.add_argument('--metrics-file', help="Write API call counts, latencies and sweep durations here as OpenMetrics text")
+    args = parser.parse_args()
+    if args.cross_check and args.backend == 'asset':
+        parser.error("--cross-check compares the list backend against the asset backend; use it with --backend list")
+
+    # Apply any per-API limits before the first call is made
+    for service, limit in parse_rate_limits(args.rate_limit).items():
+        get_governor().configure(service, rate=limit['rate'], concurrency=limit.get('concurrency'))
+
     # Define the projects you want to monitor
     projects = [
         'eighth-duality-429108-h0',
@@ -207,11 +237,98 @@ if __name__ == "__main__":
         'tfci-hst-tst-6'
     ]
 
-    for project in projects:
-        count_vpn_tunnels(project)  # Count VPN Tunnels in each project
-        count_vpcs(project)  # Count VPCs in each project
-        count_dns_zones(project)  # Count DNS Zones in each project
-        count_cloud_routers(project)  # Count Cloud Routers in each project
-        count_vpc_peerings(project)  # Count VPC Peerings in each project
-        count_firewalls(project)  # Count Firewalls in each project
-        count_private_service_access_ranges(project)  # Count Private Service Access Ranges in each project
+    if args.check:
+        sys.exit(0 if check_setup(projects) else 1)
+
+    if args.discover:
+        # Let Resource Manager filter by state and labels, reusing the local inventory while it is fresh
+        labels = dict(label.split('=', 1) for label in args.project_label)
+        projects = discover_projects(query=build_project_query(labels=labels), contains=args.project_contains)
+
+    # Counters to run for each project, compiled from the resource registry into the fewest listings
+    counters = build_counters(args.resource)
+
+    # Skip the listings that failed for good on earlier runs, unless asked to try them all again
+    get_access_cache().recheck = args.recheck_denied
+    if args.precheck_services and args.backend == 'list':
+        # One Service Usage call per project spares a failing list call for every disabled API
+        precheck_services(projects, {listing['api'] for listing in plan_listings(args.resource)},
+                          max_workers=args.workers)
+
+    # Fingerprints from the previous runs, used to skip recent checks and to publish only changes
+    sweep_state = SweepState(args.state_file) if args.incremental else None
+
+    # Journal every count as it is made; when resuming, keep the finished counts and the run ID. Counts of
+    # a listing that stopped halfway are dropped, since the listing runs again and records them anew
+    journal = SweepJournal(args.journal)
+    run_report.run_id, journaled = journal.start(run_report.run_id, resume=args.resume)
+    done = completed_listings(completed_jobs(journaled), args.resource)
+    run_report.extend([record for record in journaled if (record['project_id'], record['resource']) in done])
+    run_report.journal = journal
+
+    if args.backend == 'asset':
+        # Answer the whole summary from the asset inventory instead of listing each type in each project
+        count_all_with_assets(projects, args.resource, args.asset_scope, done=done)
+    elif args.batch:
+        # Collapse the per-project list calls into a few multipart requests per API
+        count_all_batched(projects, args.resource, done=done)
+    elif args.processes > 1:
+        # Each process counts one hash shard of the projects; their counts merge into this run's report
+        shard_counter = functools.partial(count_projects, resources=args.resource, workers=args.workers,
+                                          state_file=args.state_file if args.incremental else None,
+                                          recheck_after=args.recheck_after, journal_file=args.journal, done=done,
+                                          recheck_denied=args.recheck_denied)
+        run_report.extend(run_in_processes(projects, shard_counter, args.processes, rate_limits=args.rate_limit))
+    else:
+        # Skip resources that were checked recently enough in incremental mode, or already counted before a resume
+        skip = any_skip(recheck_skip(sweep_state, args.recheck_after) if sweep_state and args.recheck_after else None,
+                        done_skip(done) if done else None)
+
+        # Run every (project, counter) job concurrently on a bounded worker pool
+        run_sweep(projects, counters, max_workers=args.workers, skip=skip)
+    run_report.journal = None
+    journal.close()
+
+    if args.cross_check:
+        # Both backends should see the same items; differences point at lag in the asset inventory or at a bug
+        differences = cross_check(projects, args.resource, args.asset_scope)
+        for line in differences:
+            logging.warning(f"Cross-check: {line}")
+        logging.info(f"Cross-check against Cloud Asset Inventory: {len(differences)} differences")
+
+    if args.history:
+        # Every count goes into the history, even the ones incremental mode leaves out of the report
+        history = CountHistory(args.history)
+        history.append(run_report)
+        history.compact()
+        history.close()
+
+    if sweep_state is not None:
+        # Keep only the counts whose listing changed since the last run
+        changed = sweep_state.apply(run_report)
+        sweep_state.save()
+        run_report.retain(changed)
+        logging.info(f"{len(changed)} (project, resource) counts changed since the last run")
+
+    # Write every count from this run to Cloud Storage in one upload
+    run_report.upload(get_storage_client(), bucket_name, report_prefix, fmt=args.report_format, compress=args.gzip)
+
+    if args.publish_metrics:
+        # Publish the fleet-wide summary in chunks of up to 200 series per request
+        publish_metrics(run_report)
+
+    # Everything is written out, so the next run starts from scratch
+    journal.finish()
+
+    # Show how many projects and APIs are being skipped, and why
+    logging.info(f"Denied projects and APIs being skipped: {get_access_cache().stats()}")
+
+    # Show how each API's limits settled and how often it pushed back
+    for service, stats in get_governor().snapshot().items():
+        logging.info(f"API {service}: {stats}")
+
+    # Show where the time went, per API and for the slowest projects
+    for line in get_metrics().summary().splitlines():
+        logging.info(line)
+    if args.metrics_file:
+        get_metrics().write(args.metrics_file)